@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for midware. Run the whole suite from the repository root with
+
+    python -m benchmarks --output results.json
+
+and compare two runs with
+
+    python -m benchmarks.compare before.json after.json
+
+Standalone scripts like `benchmarks/bench_pipeline.py` print tables
+for a single question and are not part of the suite.
+"""
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import fnmatch
+import json
+
+from benchmarks import bench_core  # noqa: F401 registers benchmarks
+from benchmarks.harness import BENCHMARKS, run
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks', description='Runs midware benchmarks.')
+    parser.add_argument(
+        '-k',
+        '--filter',
+        default='*',
+        help='only run benchmarks with names matching this glob')
+    parser.add_argument(
+        '-o', '--output', help='write results as JSON to this file')
+    parser.add_argument(
+        '--quick',
+        action='store_true',
+        help='time shorter batches, results are noisier')
+    args = parser.parse_args()
+
+    benchmarks = [
+        b for b in BENCHMARKS if fnmatch.fnmatchcase(b[0], args.filter)
+    ]
+
+    if args.quick:
+        results = run(benchmarks, min_time=0.02, repeat=3, log=print)
+    else:
+        results = run(benchmarks, log=print)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for every public function in `midware.core`.
+"""
+
+from contextlib import nullcontext
+
+import midware.core as core
+from benchmarks.harness import benchmark
+from midware.persistent import PersistentMap
+
+PATH_DEPTHS = (1, 4, 16)
+CTX_SIZES = (1, 100, 10000)
+CHAIN_DEPTHS = (1, 10, 100)
+STYLES = ('bare', 'generator', 'layer', 'named', 'cm')
+
+
+def nested_ctx(path_depth, ctx_size):
+    """
+    Returns a `ctx` nested `path_depth` levels deep with about `ctx_size`
+    keys in total and the path to its deepest value.
+    """
+    width = max(1, ctx_size // path_depth)
+    ks = tuple('k{}'.format(width - 1) for _ in range(path_depth))
+
+    ctx = d = {}
+    for depth in range(path_depth):
+        for k in range(width):
+            d['k{}'.format(k)] = {} if depth < path_depth - 1 else k
+        d = d[ks[depth]]
+
+    return ctx, ks
+
+
+@benchmark('get_in', path_depth=PATH_DEPTHS, ctx_size=CTX_SIZES,
+           found=(True, False))
+def bench_get_in(path_depth, ctx_size, found):
+    ctx, ks = nested_ctx(path_depth, ctx_size)
+    if not found:
+        ks = ks[:-1] + ('missing', )
+
+    return lambda: core.get_in(ctx, ks)
+
+
+@benchmark('assoc_in', path_depth=PATH_DEPTHS, ctx_size=CTX_SIZES,
+           existing=(True, False))
+def bench_assoc_in(path_depth, ctx_size, existing):
+    ctx, ks = nested_ctx(path_depth, ctx_size)
+
+    if existing:
+        return lambda: core.assoc_in(ctx, ks, 0)
+
+    ks = ('missing', ) + ks
+
+    def call():
+        core.assoc_in(ctx, ks, 0)
+        del ctx['missing']
+
+    return call
+
+
+@benchmark('persistent', path_depth=PATH_DEPTHS, ctx_size=CTX_SIZES,
+           op=('get_in', 'assoc_in'))
+def bench_persistent(path_depth, ctx_size, op):
+    ctx, ks = nested_ctx(path_depth, ctx_size)
+    ctx = PersistentMap.from_dict(ctx)
+
+    if op == 'get_in':
+        return lambda: core.get_in(ctx, ks)
+    return lambda: core.assoc_in(ctx, ks, 0)
+
+
+@benchmark('path.get', path_depth=PATH_DEPTHS, ctx_size=CTX_SIZES,
+           found=(True, False))
+def bench_path_get(path_depth, ctx_size, found):
+    ctx, ks = nested_ctx(path_depth, ctx_size)
+    if not found:
+        ks = ks[:-1] + ('missing', )
+
+    get = core.path(*ks).get
+    return lambda: get(ctx)
+
+
+@benchmark('path.set', path_depth=PATH_DEPTHS, ctx_size=CTX_SIZES)
+def bench_path_set(path_depth, ctx_size):
+    ctx, ks = nested_ctx(path_depth, ctx_size)
+
+    set_ = core.path(*ks).set
+    return lambda: set_(ctx, 0)
+
+
+@benchmark('compose', funcs=(1, 8, 64))
+def bench_compose(funcs):
+    composed = core.compose(*(core.identity, ) * funcs)
+    return lambda: composed(None)
+
+
+def bare(handler):
+    def new_handler(ctx):
+        return handler(ctx)
+
+    return new_handler
+
+
+def generator(ctx):
+    new_ctx = yield ctx
+    yield new_ctx
+
+
+class Layer(core.Layer):
+    def before(self, ctx):
+        return ctx
+
+    def after(self, new_ctx):
+        return new_ctx
+
+
+LAYERS = {
+    'bare': bare,
+    'generator': core.middleware('generator')(generator),
+    'layer': Layer(),
+    'named': core.named('named')(bare),
+    'cm': core.mw_from_cm('cm', nullcontext, ('cm', )),
+}
+
+
+@benchmark('build', style=STYLES, chain_depth=CHAIN_DEPTHS)
+def bench_build(style, chain_depth):
+    layers = (LAYERS[style], ) * chain_depth
+    return lambda: core.Pipeline(core.identity, *layers)
+
+
+@benchmark('pipeline', style=STYLES, chain_depth=CHAIN_DEPTHS)
+def bench_pipeline(style, chain_depth):
+    pipeline = core.Pipeline(core.identity,
+                             *(LAYERS[style], ) * chain_depth)
+    ctx = {}
+    return lambda: pipeline(ctx)
+
+
+@benchmark('wrap_and_call', style=STYLES, chain_depth=CHAIN_DEPTHS,
+           cached=(True, False))
+def bench_wrap_and_call(style, chain_depth, cached):
+    layers = (LAYERS[style], ) * chain_depth
+    cache = core.ChainCache(maxsize=256 if cached else 0)
+    ctx = {}
+
+    def call():
+        default, core.chain_cache = core.chain_cache, cache
+        try:
+            return core.wrap_and_call(ctx, core.identity, *layers)
+        finally:
+            core.chain_cache = default
+
+    return call
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Compares calling `midware.core.wrap_and_call` with the chain cache turned off,
+so that middleware is layered on every call, with the cached
+`midware.core.wrap_and_call` and with a prebuilt `midware.core.Pipeline`.
+The `nested` column is a chain prebuilt with `midware.core.compose`, where
+every layer calls the next one instead of running in a flat loop,
+and the `compiled` one is a chain built by `midware.core.compile_chain`.
+Chains of generator middleware are measured first, then ones of
+`midware.core.Layer`s. The `saved` column is how much of the rebuilt time
+the `Pipeline` saves and the `fused` one how much the compiled chain does.
+After each table the time per layer of the nested
+chain is compared with the `Pipeline`, not counting what calling the handler
+and the `Pipeline` itself takes. A ratio below 1 means the `Pipeline`
+is faster.
+
+    python -m benchmarks.bench_pipeline
+"""
+
+import timeit
+
+import midware.core as core
+
+DEPTHS = (1, 10, 50, 500)
+
+
+@core.middleware('bench_layer')
+def bench_layer(ctx):
+    new_ctx = yield ctx
+    yield new_ctx
+
+
+class BenchLayer(core.Layer):
+    def before(self, ctx):
+        return ctx
+
+    def after(self, new_ctx):
+        return new_ctx
+
+
+def _best(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+
+def bench(depth, number=2000, layer=bench_layer):
+    layers = (layer, ) * depth
+    ctx = {}
+    pipeline = core.Pipeline(core.identity, *layers)
+    composed = core.compose(*reversed(layers))(core.identity)
+    compiled = core.compile_chain(core.identity, *layers)
+
+    def call():
+        core.wrap_and_call(ctx, core.identity, *layers)
+
+    default = core.chain_cache
+    try:
+        core.chain_cache = core.ChainCache(maxsize=0)
+        rebuilt = _best(call, number)
+        core.chain_cache = core.ChainCache()
+        cached = _best(call, number)
+    finally:
+        core.chain_cache = default
+
+    prebuilt = _best(lambda: pipeline(ctx), number)
+    nested = _best(lambda: composed(ctx), number)
+    fused = _best(lambda: compiled(ctx), number)
+
+    return rebuilt, cached, nested, prebuilt, fused
+
+
+def per_layer(depth, nested, prebuilt, number=20000):
+    """
+    Returns the time per layer of the nested chain and of the `Pipeline`
+    out of their times at `depth`, less the time of calling the handler
+    alone and through a `Pipeline` without middleware.
+    """
+    ctx = {}
+    pipeline = core.Pipeline(core.identity)
+    bare = _best(lambda: core.identity(ctx), number)
+    empty = _best(lambda: pipeline(ctx), number)
+
+    return (nested - bare) / depth, (prebuilt - empty) / depth
+
+
+if __name__ == '__main__':
+    for layer in (bench_layer, BenchLayer()):
+        print('{:>6} {:>12} {:>12} {:>12} {:>12} {:>12} {:>6} {:>6}'.format(
+            'depth', 'rebuilt, us', 'cached, us', 'nested, us',
+            'Pipeline, us', 'compiled, us', 'saved', 'fused'))
+        layer_times = []
+        for depth in DEPTHS:
+            times = bench(depth, number=max(10, 20000 // depth), layer=layer)
+            layer_times.append((depth, *per_layer(depth, *times[2:4])))
+            print('{:>6} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f} '
+                  '{:>6.0%} {:>6.0%}'.format(depth, *(t * 1e6 for t in times),
+                                             1 - times[3] / times[0],
+                                             1 - times[4] / times[0]))
+
+        print('{:>6} {:>12} {:>12} {:>12}'.format('depth', 'nested/layer',
+                                                  'Pipeline/layer', 'ratio'))
+        for depth, nested, prebuilt in layer_times:
+            print('{:>6} {:>12.3f} {:>12.3f} {:>12.2f}'.format(
+                depth, nested * 1e6, prebuilt * 1e6, prebuilt / nested))
+        print()
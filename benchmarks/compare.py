@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Compares two JSON files written by `python -m benchmarks --output`.
+
+    python -m benchmarks.compare before.json after.json
+"""
+
+import argparse
+import json
+
+from benchmarks.harness import format_params, key
+
+
+def compare(before, after):
+    """
+    Returns rows of a name, parameters, times before and after
+    and their ratio for results present in both runs.
+    """
+    old = {key(r): r for r in before['results']}
+    rows = []
+
+    for result in after['results']:
+        previous = old.get(key(result))
+        if previous is None:
+            continue
+
+        rows.append((result['name'], result['params'], previous['min_s'],
+                     result['min_s'], result['min_s'] / previous['min_s']))
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.compare',
+        description='Compares two benchmark runs.')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    for name, params, old, new, ratio in compare(before, after):
+        print('{:<16} {:<48} {:>10.3f} {:>10.3f} us {:>7.2f}x'.format(
+            name, format_params(params), old * 1e6, new * 1e6, ratio))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+A tiny `timeit`-based benchmark harness.
+
+A benchmark is a setup function registered with `benchmark` for a grid
+of parameters. It's called with every combination of parameters and
+returns a function without arguments, which is then timed.
+"""
+
+import itertools
+import platform
+import statistics
+import sys
+import time
+import timeit
+
+BENCHMARKS = []
+
+
+def benchmark(name, **params):
+    """
+    Registers a setup function under `name` for every combination
+    of values in `params`, which maps parameter names to sequences.
+    """
+
+    def register(setup):
+        keys = list(params)
+        for values in itertools.product(*(params[k] for k in keys)):
+            BENCHMARKS.append((name, dict(zip(keys, values)), setup))
+        return setup
+
+    return register
+
+
+def measure(fn, min_time=0.2, repeat=5):
+    """
+    Times `fn`, calling it in batches that take at least `min_time` seconds,
+    and returns the best and the median time of one call in seconds.
+    """
+    timer = timeit.Timer(fn)
+
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+
+    return {
+        'number': number,
+        'min_s': min(times),
+        'median_s': statistics.median(times),
+    }
+
+
+def run(benchmarks, min_time=0.2, repeat=5, log=None):
+    """
+    Runs `benchmarks` and returns results that can be dumped to JSON.
+    """
+    results = []
+
+    for name, params, setup in benchmarks:
+        result = dict(name=name, params=params, **measure(
+            setup(**params), min_time=min_time, repeat=repeat))
+        results.append(result)
+
+        if log is not None:
+            log(format_result(result))
+
+    return {
+        'meta': {
+            'python': sys.version,
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+
+
+def key(result):
+    """
+    Returns a hashable key that identifies a result across runs.
+    """
+    return result['name'], tuple(sorted(result['params'].items()))
+
+
+def format_params(params):
+    return ' '.join('{}={}'.format(k, v) for k, v in params.items())
+
+
+def format_result(result):
+    return '{:<16} {:<48} {:>12.3f} us'.format(
+        result['name'], format_params(result['params']),
+        result['min_s'] * 1e6)
@@ -31,3 +31,5 @@ Once again, middleware is composable, because it takes handles and returns handl
 When using middleware as building blocks, composing those returns an outermost handle,
 which needs to be called with a `ctx` value as an argument to kick off the computation.
 """
+
+from midware.context import Context  # noqa: F401
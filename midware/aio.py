@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+"""
+This module is the `asyncio` counterpart of `midware.core`.
+
+Handlers are coroutine functions and middleware takes an async handler
+and returns a new async handler. The function called `midware.aio.middleware`
+turns async generators into such middleware:
+
+    @midware.aio.middleware('wrap_smth')
+    async def wrap_smth(ctx):
+        # do smth with ctx, await something
+        new_ctx = yield ctx
+        # do some post-processing with new_ctx
+        yield new_ctx
+
+Generator middleware made by `midware.core.middleware` and
+`midware.core.Layer`s can be mixed in, because they never call
+the handler themselves. Middleware defined without
+generators can be named with `midware.aio.named`.
+
+`midware.aio.mw_from_acm` is `midware.core.mw_from_cm` for async context
+managers. Adjacent layers made by it that don't read each other's resources
+are entered at the same time.
+
+`midware.aio.wrap_and_call_async` layers middleware around a handler and
+awaits it, while `midware.aio.AsyncPipeline` builds the layers once.
+"""
+
+import asyncio
+import inspect
+from contextlib import AsyncExitStack
+
+from midware import core
+from midware.core import (_build_instrumented, _ctx_kwargs, _instrumentation,
+                          _probe_for, _restore_pipeline, _take_name, assoc_in)
+
+
+def _probed(probe, name, handler):
+    """
+    Returns an async handler that calls `probe` around the async `handler`.
+    """
+    enter = probe.enter
+    exit_ = probe.exit
+
+    async def probed_handler(ctx):
+        token = enter(name, ctx)
+
+        try:
+            new_ctx = await handler(ctx)
+        except BaseException as e:
+            exit_(name, token, ctx, e)
+            raise
+
+        exit_(name, token, new_ctx, None)
+
+        return new_ctx
+
+    return probed_handler
+
+
+def _instrument(name, handler):
+    """
+    Instruments an async `handler` of a layer called `name` with the current
+    probe. Without a probe the `handler` is returned as is.
+    """
+    probe = _instrumentation.get()
+    if probe is None:
+        return handler
+
+    return _probed(probe, name, handler)
+
+
+def middleware(name, *args, **kwargs):
+    """
+    This function is used to decorate async generators with exactly two
+    `yield` statements and turn them into async middleware.
+
+    Extra arguments beyond name are passed to the generator that is being
+    decorated during instantiation, same as in `midware.core.middleware`.
+    """
+
+    def new_annotate(g_fn):
+        def new_middleware(handler):
+            async def new_handler(ctx):
+                g = g_fn(ctx, *args, **kwargs)
+
+                changed_ctx = await g.__anext__()
+                new_ctx = await handler(changed_ctx)
+                last_ctx = await g.asend(new_ctx)
+
+                return last_ctx
+
+            return _instrument(name, new_handler)
+
+        new_middleware._midware_async_generator = (name, g_fn, args, kwargs)
+
+        return _take_name(new_middleware, g_fn)
+
+    return new_annotate
+
+
+def named(name):
+    """
+    This function is used to decorate async middleware functions in order
+    for their before and after sections to show up during a verbose run.
+    """
+
+    def new_annotate(mware):
+        def new_middleware(handler):
+            return _instrument(name, mware(handler))
+
+        return _take_name(new_middleware, mware)
+
+    return new_annotate
+
+
+def mw_from_acm(name, acm_constructor, ks=None, ctx_args={}, **kwargs):
+    """
+    Returns async middleware that enters `acm_constructor(**kwargs)` with
+    `async with`, associates the resource with `ks` in the `ctx` and awaits
+    the handler, like `midware.core.mw_from_cm` does. Extra arguments are
+    taken from the `ctx` with `ctx_args`, which maps their names to paths.
+
+    When a chain is built, adjacent layers made by this function that don't
+    read resources of one another with `ctx_args` are entered concurrently,
+    unless the chain is instrumented. They're still exited one by one
+    in reverse order.
+    """
+
+    def new_middleware(handler):
+        async def new_handler(ctx):
+            ctx_kwargs = _ctx_kwargs(ctx, ctx_args)
+
+            async with acm_constructor(**ctx_kwargs, **kwargs) as v:
+                if ks:
+                    assoc_in(ctx, ks, v)
+                new_ctx = await handler(ctx)
+
+            return new_ctx
+
+        return _instrument(name, new_handler)
+
+    new_middleware._midware_acm = (acm_constructor, ks, ctx_args, kwargs)
+
+    return new_middleware
+
+
+def _depends(acm, others):
+    """
+    Returns whether an async context manager layer reads a resource
+    of any of the `others` with its `ctx_args`.
+    """
+    _, _, ctx_args, _ = acm
+    paths = ctx_args.values() if hasattr(ctx_args, 'items') else [
+        ks for _, ks in ctx_args
+    ]
+
+    for _, ks, _, _ in others:
+        if not ks:
+            continue
+        ks = tuple(ks)
+        for ks_ in paths:
+            ks_ = tuple(ks_)
+            n = min(len(ks), len(ks_))
+            if ks[:n] == ks_[:n]:
+                return True
+
+    return False
+
+
+def _gathered(handler, acms):
+    """
+    Returns an async handler that enters async context managers of `acms`
+    concurrently around the `handler` and exits them in reverse order.
+    Ones that have been entered are exited even if the rest are cancelled.
+    """
+
+    async def gathered_handler(ctx):
+        cms = [
+            acm_constructor(**_ctx_kwargs(ctx, ctx_args), **kwargs)
+            for acm_constructor, _, ctx_args, kwargs in acms
+        ]
+
+        entered = [False] * len(cms)
+
+        async def enter(i, cm):
+            v = await cm.__aenter__()
+            entered[i] = True
+            return v
+
+        async with AsyncExitStack() as stack:
+            try:
+                results = await asyncio.gather(
+                    *(enter(i, cm) for i, cm in enumerate(cms)),
+                    return_exceptions=True)
+            finally:
+                for cm, is_entered in zip(cms, entered):
+                    if is_entered:
+                        stack.push_async_exit(cm)
+
+            for v in results:
+                if isinstance(v, BaseException):
+                    raise v
+
+            for (_, ks, _, _), v in zip(acms, results):
+                if ks:
+                    assoc_in(ctx, ks, v)
+
+            return await handler(ctx)
+
+    return gathered_handler
+
+
+def _enter_concurrently(handler, middleware):
+    """
+    Layers async context manager `middleware` around the `handler`,
+    so that every run of independent ones is entered at once.
+    """
+    groups = []
+    for mw in middleware:
+        acm = mw._midware_acm
+        if not groups or _depends(acm, [a for _, a in groups[-1]]):
+            groups.append([])
+        groups[-1].append((mw, acm))
+
+    for group in reversed(groups):
+        if len(group) == 1:
+            handler = group[0][0](handler)
+        else:
+            handler = _gathered(handler, [acm for _, acm in group])
+
+    return handler
+
+
+def _awaiting(handler):
+    """
+    Returns a coroutine function that calls `handler`
+    and awaits the result if it's awaitable.
+    """
+
+    async def awaiting_handler(ctx):
+        new_ctx = handler(ctx)
+        if inspect.isawaitable(new_ctx):
+            new_ctx = await new_ctx
+        return new_ctx
+
+    return awaiting_handler
+
+
+async def _close(g):
+    """
+    Closes a sync or an async generator.
+    """
+    if inspect.isasyncgen(g):
+        await g.aclose()
+    else:
+        g.close()
+
+
+def _flatten(handler, steps):
+    """
+    Returns an async handler that runs a sequence of sync and async generator
+    middleware and layers `steps` around the `handler` in a loop instead of
+    nesting them. Steps are the ones of `midware.core._flatten` with whether
+    the generator is async after the name.
+    """
+    probe = _instrumentation.get()
+    if probe is not None:
+        return _probed_flatten(probe, handler, steps)
+
+    if all(g_fn is None for _, _, g_fn, *_ in steps):
+        return _layered(handler, steps)
+
+    back_steps = [(is_async, g_fn is None)
+                  for _, is_async, g_fn, *_ in reversed(steps)]
+
+    async def flat_handler(ctx):
+        backs = []
+        push = backs.append
+
+        try:
+            for _, is_async, g_fn, args, kwargs in steps:
+                if g_fn is None:
+                    if args is not None:
+                        ctx = args(ctx)
+                    push(kwargs)
+                    continue
+
+                g = g_fn(ctx, *args, **kwargs)
+                push(g)
+                ctx = await g.__anext__() if is_async else next(g)
+
+            ctx = await handler(ctx)
+
+            for back, (is_async, is_layer) in zip(reversed(backs),
+                                                  back_steps):
+                if is_async:
+                    ctx = await back.asend(ctx)
+                elif not is_layer:
+                    ctx = back.send(ctx)
+                elif back is not None:
+                    ctx = back(ctx)
+        except BaseException:
+            for back, (_, _, g_fn, *_) in zip(reversed(backs),
+                                              steps[len(backs) - 1::-1]):
+                if g_fn is not None:
+                    await _close(back)
+            raise
+
+        return ctx
+
+    return flat_handler
+
+
+def _layered(handler, steps):
+    """
+    Same as `midware.aio._flatten` for `steps` that are all layers.
+    """
+    befores = [before for _, _, _, before, _ in steps if before is not None]
+    afters = [
+        after for _, _, _, _, after in reversed(steps) if after is not None
+    ]
+
+    async def layered_handler(ctx):
+        for before in befores:
+            ctx = before(ctx)
+
+        ctx = await handler(ctx)
+
+        for after in afters:
+            ctx = after(ctx)
+
+        return ctx
+
+    return layered_handler
+
+
+def _probed_flatten(probe, handler, steps):
+    """
+    Same as `midware.aio._flatten`, but calls `probe` around every step.
+    """
+    enter = probe.enter
+    exit_ = probe.exit
+    names = [name for name, *_ in steps]
+
+    async def probed_flat_handler(ctx):
+        backs = []
+        tokens = []
+
+        try:
+            for name, is_async, g_fn, args, kwargs in steps:
+                tokens.append(enter(name, ctx))
+                if g_fn is None:
+                    if args is not None:
+                        ctx = args(ctx)
+                    backs.append(kwargs)
+                    continue
+
+                g = g_fn(ctx, *args, **kwargs)
+                backs.append(g)
+                ctx = await g.__anext__() if is_async else next(g)
+
+            ctx = await handler(ctx)
+
+            for name, is_async, g_fn, *_ in reversed(steps):
+                back = backs.pop()
+                if is_async:
+                    ctx = await back.asend(ctx)
+                elif g_fn is not None:
+                    ctx = back.send(ctx)
+                elif back is not None:
+                    ctx = back(ctx)
+                exit_(name, tokens.pop(), ctx, None)
+        except BaseException as e:
+            while tokens:
+                i = len(tokens) - 1
+                if len(backs) == len(tokens):
+                    back = backs.pop()
+                    if steps[i][2] is not None:
+                        await _close(back)
+                exit_(names[i], tokens.pop(), ctx, e)
+            raise
+
+        return ctx
+
+    return probed_flat_handler
+
+
+def _build(handler, middleware):
+    """
+    Layers async `middleware` left to right around the `handler`
+    and returns the outermost async handler.
+
+    Adjacent generator middleware, both sync and async, and layers
+    are run by one flat handler, so deep chains don't grow the call stack.
+    Adjacent independent async context managers are entered at once.
+    Named layers are instrumented with the current probe.
+    """
+    if not inspect.iscoroutinefunction(handler):
+        handler = _awaiting(handler)
+
+    gather = _instrumentation.get() is None
+    steps = []
+    acms = []
+
+    for mw in reversed(middleware):
+        if gather and hasattr(mw, '_midware_acm'):
+            if steps:
+                handler = _flatten(handler, steps[::-1])
+                steps = []
+            acms.append(mw)
+            continue
+
+        if acms:
+            handler = _enter_concurrently(handler, acms[::-1])
+            acms = []
+
+        step = getattr(mw, '_midware_async_generator', None)
+        if step is not None:
+            steps.append((step[0], True) + step[1:])
+            continue
+
+        step = core._step(mw)
+        if step is not None:
+            steps.append((step[0], False) + step[1:])
+            continue
+
+        if steps:
+            handler = _flatten(handler, steps[::-1])
+            steps = []
+        handler = mw(handler)
+
+    if steps:
+        handler = _flatten(handler, steps[::-1])
+    if acms:
+        handler = _enter_concurrently(handler, acms[::-1])
+
+    return handler
+
+
+class AsyncPipeline:
+    """
+    A `handler` layered with async `middleware` left to right once, so that
+    it can be awaited with many `ctx` values without rebuilding the chain.
+    `await AsyncPipeline(handler, *middleware)(ctx)` is the same as
+    `await wrap_and_call_async(ctx, handler, *middleware)`.
+
+    The `handler` is usually a coroutine function, but a plain
+    function works too. Instrumentation is chosen with `verbose` and
+    `instrument` the same way as in `midware.core.Pipeline`.
+    """
+
+    def __init__(self, handler, *middleware, verbose=False, instrument=None):
+        self.handler = handler
+        self.middleware = middleware
+        self.probe = _probe_for(instrument, verbose)
+        self._wrapped = _build_instrumented(_build, handler, middleware,
+                                            self.probe)
+
+    def __call__(self, ctx):
+        return self._wrapped(ctx)
+
+    def __reduce__(self):
+        return _restore_pipeline, (type(self), self.handler, self.middleware,
+                                   self.probe)
+
+
+chain_cache = core.ChainCache(build=_build)
+"""
+The `midware.core.ChainCache` used by `midware.aio.wrap_and_call_async`.
+"""
+
+
+async def wrap_and_call_async(ctx,
+                              handler,
+                              *middleware,
+                              verbose=False,
+                              instrument=None):
+    """
+    This function layers async `middleware` left to right around
+    the `handler` and awaits it all with `ctx` as an argument.
+
+    Setting `verbose` to `True` prints when handlers start their
+    before and after sections. Other kinds of instrumentation can be
+    chosen with `instrument`, see `midware.core.instrumented`.
+    """
+    probe = _probe_for(instrument, verbose)
+
+    return await chain_cache.get(handler, middleware, probe)(ctx)
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+Caching results of handlers that only depend on a few paths of the `ctx`.
+
+A `midware.cache.ResultCache` is middleware, it looks up values of the paths
+before calling the inner handler, and on a hit the handler and all layers
+inside are skipped, while the cached result is merged into the `ctx`:
+
+    cache = midware.cache.ResultCache('prices', [('request', 'sku')],
+                                      outputs=[('price', )], ttl=60)
+    pipeline = midware.core.Pipeline(handler, *outer, cache, *inner)
+
+A `midware.cache.SingleFlight` doesn't keep results, but makes calls
+with the same values of the paths that come while one of them is running
+wait for its result instead of running the inner chain too.
+
+Both work in chains of `midware.core` and `midware.aio` alike.
+"""
+
+import asyncio
+import inspect
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from midware import aio, core
+from midware.context import Context
+from midware.core import Path
+from midware.persistent import PersistentMap
+
+_CONTAINERS = (list, tuple, set, frozenset)
+_MISSING = core._MISSING
+
+
+def _sizeof(obj, seen=None):
+    """
+    Returns an estimate of the size of `obj` in bytes, including
+    the contents of nested containers and mappings.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if type(obj) is dict or isinstance(obj, core._MAPPINGS):
+        for k, v in obj.items():
+            size += _sizeof(k, seen) + _sizeof(v, seen)
+    elif isinstance(obj, _CONTAINERS):
+        for v in obj:
+            size += _sizeof(v, seen)
+
+    return size
+
+
+def _copy(obj):
+    """
+    Returns a copy of `obj` where nested `dict`s, `list`s, `set`s and
+    `midware.context.Context`s are copied too, while other values are shared.
+    """
+    cls = type(obj)
+    if cls is dict:
+        return {k: _copy(v) for k, v in obj.items()}
+    if cls is list:
+        return [_copy(v) for v in obj]
+    if cls is set:
+        return set(obj)
+    if isinstance(obj, Context):
+        return cls((k, _copy(v)) for k, v in obj.items())
+
+    return obj
+
+
+class _Entry:
+    __slots__ = ('result', 'error', 'expires', 'size')
+
+    def __init__(self, result, error, expires, size):
+        self.result = result
+        self.error = error
+        self.expires = expires
+        self.size = size
+
+
+class _Keyed:
+    """
+    Middleware that tells calls apart by the values of `paths` in the `ctx`
+    and can merge values of `outputs` of one call into another `ctx`,
+    or top-level values it added or replaced if there are no `outputs`.
+    Values are copied with `_copy` when they're taken and when they're merged,
+    so calls don't share them.
+    """
+
+    def __init__(self, name, paths, outputs=None):
+        self.name = name
+        self.paths = [ks if isinstance(ks, Path) else Path(ks) for ks in paths]
+        self.outputs = None if outputs is None else [
+            ks if isinstance(ks, Path) else Path(ks) for ks in outputs
+        ]
+        self._getters = [p.get for p in self.paths]
+
+    def key(self, ctx):
+        """
+        Returns the key of a `ctx`, or `None` if it's not hashable.
+        """
+        key = tuple(get(ctx) for get in self._getters)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _before(self, ctx):
+        """
+        Returns what `_result` compares the resulting `ctx` with.
+        """
+        if self.outputs is not None or isinstance(ctx, PersistentMap):
+            return ctx
+        return dict(ctx.items())
+
+    def _result(self, before, new_ctx):
+        if self.outputs is None:
+            return [(k, _copy(v)) for k, v in new_ctx.items()
+                    if before.get(k, _MISSING) is not v]
+        return [(p.set, _copy(p.get(new_ctx))) for p in self.outputs]
+
+    def _merge(self, ctx, result):
+        if self.outputs is not None:
+            for set_, v in result:
+                ctx = set_(ctx, _copy(v))
+            return ctx
+
+        if isinstance(ctx, PersistentMap):
+            return ctx.update((k, _copy(v)) for k, v in result)
+        for k, v in result:
+            ctx[k] = _copy(v)
+        return ctx
+
+    def __call__(self, handler):
+        if inspect.iscoroutinefunction(handler):
+            return aio._instrument(self.name, self._async_handler(handler))
+
+        return core._instrument(self.name, self._handler(handler))
+
+
+class ResultCache(_Keyed):
+    """
+    Middleware that caches what the inner handler puts into the `ctx`, keyed
+    by the values of `paths` in it. Values that aren't hashable make
+    the call bypass the cache.
+
+    With `outputs`, only values of those paths are cached and merged,
+    otherwise top-level values that the inner chain added or replaced are,
+    but not changes made inside values that were already there. Cached
+    values are copied, so changing them in one call doesn't affect others.
+
+    Results are evicted when they are the least recently used and there are
+    more than `maxsize` of them or their estimated size is more than
+    `maxbytes`, as well as when they're older than `ttl` seconds.
+    When `error_ttl` is set, an `Exception` raised inside is cached too and
+    raised again for the same key for that many seconds.
+    """
+
+    def __init__(self,
+                 name,
+                 paths,
+                 outputs=None,
+                 maxsize=1024,
+                 ttl=None,
+                 maxbytes=None,
+                 error_ttl=None):
+        super().__init__(name, paths, outputs)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.error_ttl = error_ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key):
+        if key is None:
+            return None, False
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires is not None and \
+                    entry.expires <= time.monotonic():
+                self._evict(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None, True
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry, True
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        self.nbytes -= entry.size
+        self.evictions += 1
+
+    def _store(self, key, result, error):
+        ttl = self.ttl if error is None else self.error_ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        size = _sizeof(result) if self.maxbytes is not None else 0
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).size
+            self._entries[key] = _Entry(result, error, expires, size)
+            self.nbytes += size
+
+            while len(self._entries) > self.maxsize or (
+                    self.maxbytes is not None and self.nbytes > self.maxbytes):
+                self._evict(next(iter(self._entries)))
+
+    def _hit(self, ctx, entry):
+        if entry.error is not None:
+            raise entry.error.with_traceback(None)
+        return self._merge(ctx, entry.result)
+
+    def _handler(self, handler):
+        def new_handler(ctx):
+            key = self.key(ctx)
+            entry, cacheable = self._lookup(key)
+            if entry is not None:
+                return self._hit(ctx, entry)
+
+            before = self._before(ctx) if cacheable else None
+            try:
+                new_ctx = handler(ctx)
+            except Exception as e:
+                if cacheable and self.error_ttl is not None:
+                    self._store(key, None, e)
+                raise
+
+            if cacheable:
+                self._store(key, self._result(before, new_ctx), None)
+
+            return new_ctx
+
+        return new_handler
+
+    def _async_handler(self, handler):
+        async def new_handler(ctx):
+            key = self.key(ctx)
+            entry, cacheable = self._lookup(key)
+            if entry is not None:
+                return self._hit(ctx, entry)
+
+            before = self._before(ctx) if cacheable else None
+            try:
+                new_ctx = await handler(ctx)
+            except Exception as e:
+                if cacheable and self.error_ttl is not None:
+                    self._store(key, None, e)
+                raise
+
+            if cacheable:
+                self._store(key, self._result(before, new_ctx), None)
+
+            return new_ctx
+
+        return new_handler
+
+    def clear(self):
+        """
+        Drops all results and resets the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        """
+        Returns counters and sizes as a `dict`.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'nbytes': self.nbytes,
+                'maxbytes': self.maxbytes,
+            }
+
+
+class _Flight:
+    """
+    A call in flight, which other calls with the same key wait for.
+    """
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self, done):
+        self.done = done
+        self.result = _MISSING
+        self.error = None
+
+
+class SingleFlight(_Keyed):
+    """
+    Middleware that lets one call at a time with the same values of `paths`
+    run the inner chain, while the others wait for it to finish and get its
+    result merged into their `ctx`, the way `midware.cache.ResultCache`
+    merges it, or its `Exception` raised. Without `outputs`, that's only
+    what the inner chain added or replaced, so other fields of every `ctx`
+    are kept. Calls with values that aren't hashable are never coalesced.
+
+    Threads wait for calls made by other threads and `asyncio` tasks for
+    ones made by tasks on the same event loop. If a call is interrupted
+    by something that's not an `Exception`, like a cancellation,
+    one of the waiting calls runs the inner chain instead.
+    """
+
+    def __init__(self, name, paths, outputs=None):
+        super().__init__(name, paths, outputs)
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key, make_done):
+        """
+        Returns the flight of `key` and whether it's been started
+        by this call.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight(make_done())
+                self.calls += 1
+                return flight, True
+
+            self.coalesced += 1
+            return flight, False
+
+    def _land(self, key, flight):
+        with self._lock:
+            del self._flights[key]
+        flight.done.set()
+
+    def _outcome(self, ctx, flight):
+        if flight.error is not None:
+            raise flight.error.with_traceback(None)
+        return self._merge(ctx, flight.result)
+
+    def _handler(self, handler):
+        def new_handler(ctx):
+            key = self.key(ctx)
+            if key is None:
+                return handler(ctx)
+
+            while True:
+                flight, leader = self._join(key, threading.Event)
+                if leader:
+                    break
+                flight.done.wait()
+                if flight.error is not None or flight.result is not _MISSING:
+                    return self._outcome(ctx, flight)
+
+            before = self._before(ctx)
+            try:
+                new_ctx = handler(ctx)
+                flight.result = self._result(before, new_ctx)
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                self._land(key, flight)
+
+            return new_ctx
+
+        return new_handler
+
+    def _async_handler(self, handler):
+        async def new_handler(ctx):
+            key = self.key(ctx)
+            if key is None:
+                return await handler(ctx)
+
+            key = (id(asyncio.get_running_loop()), key)
+
+            while True:
+                flight, leader = self._join(key, asyncio.Event)
+                if leader:
+                    break
+                await flight.done.wait()
+                if flight.error is not None or flight.result is not _MISSING:
+                    return self._outcome(ctx, flight)
+
+            before = self._before(ctx)
+            try:
+                new_ctx = await handler(ctx)
+                flight.result = self._result(before, new_ctx)
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                self._land(key, flight)
+
+            return new_ctx
+
+        return new_handler
+
+    def info(self):
+        """
+        Returns counters as a `dict`: calls that ran the inner chain,
+        calls that waited for them instead and calls in flight right now.
+        """
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._flights),
+            }
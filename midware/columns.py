@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+Columns of values pulled out of many contexts.
+
+`midware.columns.get_in_many` is `midware.core.get_in` for a sequence
+of contexts and several paths at once. Values of every path go to an array,
+so they can be aggregated without a loop in Python:
+
+    latency, size = midware.columns.get_in_many(
+        results, [('timing', 'latency'), ('response', 'size')])
+    latency.mean()
+
+Arrays are NumPy arrays when NumPy is installed and `array.array`s otherwise.
+
+`midware.columns.ContextBatch` keeps many contexts as columns, one for every
+leaf path, and `midware.columns.run_batch` runs a chain over a batch one
+layer at a time. `midware.columns.BatchLayer`s work on whole columns then,
+while other generator middleware and layers are applied to every row:
+
+    class Scale(midware.columns.BatchLayer):
+        def before_batch(self, batch):
+            batch['value'] = numpy.asarray(batch['value']) * 2
+            return batch
+
+    batch = midware.columns.ContextBatch.from_contexts(ctxs)
+    batch = midware.columns.run_batch(batch, handler, Scale(), wrap_smth)
+    batch.to_contexts()
+"""
+
+from array import array
+
+from midware import core
+from midware.core import Layer, Path
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_TYPECODES = {
+    'float64': 'd',
+    'float32': 'f',
+    'int64': 'q',
+    'int32': 'i',
+    'int16': 'h',
+    'int8': 'b',
+    'uint64': 'Q',
+    'uint32': 'I',
+    'uint16': 'H',
+    'uint8': 'B',
+    'bool': 'B',
+    float: 'd',
+    int: 'q',
+    bool: 'B',
+}
+"""
+`array.array` typecodes of NumPy dtypes, used when NumPy is absent.
+"""
+
+
+def _typecode(dtype):
+    if dtype in _TYPECODES:
+        return _TYPECODES[dtype]
+    if isinstance(dtype, str) and len(dtype) == 1:
+        return dtype
+
+    raise ValueError('unsupported dtype without numpy: {!r}'.format(dtype))
+
+
+def _to_array(values, dtype):
+    if numpy is not None:
+        return numpy.array(values, dtype=dtype)
+
+    return array(_typecode(dtype), values)
+
+
+def _columns(ctxs, getters, default):
+    """
+    Returns a list of values for every getter, taking each `ctx` once.
+    """
+    if len(getters) == 1:
+        get = getters[0]
+        return [[get(ctx, default) for ctx in ctxs]]
+
+    columns = [[] for _ in getters]
+    pairs = [(get, column.append) for get, column in zip(getters, columns)]
+
+    for ctx in ctxs:
+        for get, append in pairs:
+            append(get(ctx, default))
+
+    return columns
+
+
+def get_in_many(ctxs, paths, dtype='float64', default=0):
+    """
+    Returns a tuple with an array of values for every path of `paths`,
+    in order, taken from every `ctx` of `ctxs`, which is iterated once.
+    Paths are sequences of keys or `midware.core.Path`s, and `default`
+    is used where a path is missing.
+
+    `dtype` is a NumPy dtype, or a sequence of them, one for every path.
+    Without NumPy it's one of the names like `'float64'` or `'int32'`,
+    `float`, `int` and `bool`, or an `array.array` typecode.
+    """
+    paths = [ks if isinstance(ks, Path) else Path(ks) for ks in paths]
+    if isinstance(dtype, (list, tuple)):
+        if len(dtype) != len(paths):
+            raise ValueError('expected a dtype for every path')
+        dtypes = dtype
+    else:
+        dtypes = [dtype] * len(paths)
+
+    if not paths:
+        return ()
+
+    columns = _columns(ctxs, [p.get for p in paths], default)
+
+    return tuple(
+        _to_array(column, dtype) for column, dtype in zip(columns, dtypes))
+
+
+def _leaves(d, prefix, leaves):
+    """
+    Adds leaf paths and values of a nested `d` to a `dict` of `leaves`.
+    """
+    for k, v in d.items():
+        ks = prefix + (k, )
+        if (type(v) is dict or isinstance(v, core._MAPPINGS)) and v:
+            _leaves(v, ks, leaves)
+        else:
+            leaves[ks] = v
+
+    return leaves
+
+
+def _path_key(ks):
+    if isinstance(ks, Path):
+        return ks.keys
+    if isinstance(ks, tuple):
+        return ks
+    if isinstance(ks, list):
+        return tuple(ks)
+
+    return (ks, )
+
+
+class ContextBatch:
+    """
+    Many contexts stored as columns keyed by leaf paths, which are tuples
+    of keys. A column is any sequence as long as the batch, like a `list`
+    or a NumPy array, so layers can replace whole columns at once:
+
+        batch[('timing', 'latency')] = numpy.asarray(latency) / 1e6
+
+    A single key can be used in place of a path of one key.
+    """
+
+    __slots__ = ('_columns', '_size')
+
+    def __init__(self, columns=None, size=None):
+        self._columns = {}
+        self._size = size
+
+        for ks, column in (columns or {}).items():
+            self[ks] = column
+
+        if self._size is None:
+            self._size = 0
+
+    @classmethod
+    def from_contexts(cls, ctxs):
+        """
+        Returns a batch with a column for every leaf path of `ctxs`.
+        Contexts that lack a path get `None` in its column.
+        """
+        columns = {}
+        size = 0
+
+        for i, ctx in enumerate(ctxs):
+            for ks, v in _leaves(ctx, (), {}).items():
+                column = columns.get(ks)
+                if column is None:
+                    column = columns[ks] = [None] * i
+                column.append(v)
+            size = i + 1
+            for column in columns.values():
+                if len(column) < size:
+                    column.append(None)
+
+        return cls(columns, size)
+
+    def to_contexts(self):
+        """
+        Returns a list of nested `dict`s, one for every row.
+        `None`s are left out, so missing paths stay missing.
+        """
+        rows = [{} for _ in range(self._size)]
+
+        for ks in sorted(self._columns, key=len):
+            column = self._columns[ks]
+            if hasattr(column, 'tolist'):
+                column = column.tolist()
+            set_ = Path(ks).set
+            for row, v in zip(rows, column):
+                if v is not None:
+                    set_(row, v)
+
+        return rows
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, ks):
+        return self._columns[_path_key(ks)]
+
+    def __setitem__(self, ks, column):
+        if self._size is None:
+            self._size = len(column)
+        elif len(column) != self._size:
+            raise ValueError('expected a column of {} values, got {}'.format(
+                self._size, len(column)))
+
+        self._columns[_path_key(ks)] = column
+
+    def __delitem__(self, ks):
+        del self._columns[_path_key(ks)]
+
+    def __contains__(self, ks):
+        return _path_key(ks) in self._columns
+
+    def paths(self):
+        """
+        Returns the leaf paths of all columns.
+        """
+        return list(self._columns)
+
+    def __repr__(self):
+        return '{}({} rows, {})'.format(
+            type(self).__name__, self._size,
+            ', '.join(map(repr, self._columns)))
+
+
+class BatchLayer(Layer):
+    """
+    A `midware.core.Layer` that can work on a whole
+    `midware.columns.ContextBatch` when it's run by
+    `midware.columns.run_batch`. `before_batch` gets the batch and
+    returns the one passed inwards and `after_batch` gets the result of
+    the inner layers and returns the one passed outwards.
+
+    In other chains `before` and `after` are called for every `ctx`,
+    so a layer that overrides both kinds of methods works everywhere.
+    """
+
+    __slots__ = ()
+
+    def before_batch(self, batch):
+        return batch
+
+    def after_batch(self, batch):
+        return batch
+
+
+def _as_batch(data):
+    if isinstance(data, ContextBatch):
+        return data
+    return ContextBatch.from_contexts(data)
+
+
+def _as_rows(data):
+    if isinstance(data, ContextBatch):
+        return data.to_contexts()
+    return data
+
+
+def run_batch(batch, handler, *middleware, batched=False):
+    """
+    Runs a `batch` through `middleware` layered left to right around the
+    `handler` breadth-first: every layer's before section is done for the
+    whole batch before the next layer starts, and the same goes for after
+    sections on the way back. Returns the resulting batch.
+
+    `midware.columns.BatchLayer`s get the batch, while generator middleware
+    and other `midware.core.Layer`s are applied to every row. The `handler`
+    is called for every row, or with the batch if `batched` is `True`.
+    Other middleware can't be split into sections, so it's a `TypeError`.
+
+    Going between a batch and rows copies every value, so batch layers
+    and row-wise layers are cheaper when they are grouped.
+    """
+    steps = []
+    for mw in middleware:
+        if isinstance(mw, BatchLayer):
+            steps.append(mw)
+            continue
+
+        step = core._step(mw)
+        if step is None:
+            raise TypeError(
+                "can't run {!r} on a batch, only generator middleware "
+                'and layers can be'.format(mw))
+        steps.append(step)
+
+    data = batch
+    backs = []
+
+    try:
+        for step in steps:
+            if isinstance(step, BatchLayer):
+                data = step.before_batch(_as_batch(data))
+                backs.append(step.after_batch)
+                continue
+
+            _, g_fn, args, kwargs = step
+            rows = _as_rows(data)
+
+            if g_fn is None:
+                if args is not None:
+                    rows = [args(ctx) for ctx in rows]
+                backs.append(kwargs)
+            else:
+                gens = []
+                backs.append(gens)
+                for ctx in rows:
+                    gens.append(g_fn(ctx, *args, **kwargs))
+                rows = [next(g) for g in gens]
+            data = rows
+
+        if batched:
+            data = handler(_as_batch(data))
+        else:
+            data = [handler(ctx) for ctx in _as_rows(data)]
+
+        while backs:
+            back = backs.pop()
+            step = steps[len(backs)]
+            if isinstance(step, BatchLayer):
+                data = back(_as_batch(data))
+            elif step[1] is not None:
+                data = [g.send(ctx) for g, ctx in zip(back, _as_rows(data))]
+            elif back is not None:
+                data = [back(ctx) for ctx in _as_rows(data)]
+    except BaseException:
+        for back in reversed(backs):
+            if type(back) is list:
+                for g in back:
+                    g.close()
+        raise
+
+    return _as_batch(data)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+A compact `ctx` with declared fields.
+
+`midware.context.Context` is a mutable mapping, so it can be used wherever
+a `dict` is used as `ctx`. Subclasses declare the keys they expect
+in `__slots__`, which are stored without a per-instance `dict`:
+
+    class Request(midware.Context):
+        __slots__ = ('user', 'body')
+
+    ctx = Request(user='alice')
+    ctx['user']                                # 'alice'
+    ctx.user                                   # 'alice'
+    midware.core.assoc_in(ctx, ('meta', 'retries'), 3)
+
+Keys that are not declared go to an overflow `dict`, which is only created
+when it's needed. A declared field that was never set is a missing key.
+"""
+
+from collections.abc import MutableMapping
+
+_NOT_FIELDS = frozenset(('_extra', '__dict__', '__weakref__'))
+
+
+class Context(MutableMapping):
+    """
+    A mutable mapping that stores declared keys in `__slots__`
+    and the rest in an overflow `dict`.
+    """
+
+    __slots__ = ('_extra', )
+
+    _fields = frozenset()
+    _field_order = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        order = []
+        for klass in reversed(cls.__mro__):
+            slots = klass.__dict__.get('__slots__', ())
+            if isinstance(slots, str):
+                slots = (slots, )
+            order += [k for k in slots if k not in _NOT_FIELDS]
+
+        clashes = set(order) & set(dir(Context))
+        if clashes:
+            raise TypeError('fields clash with Context methods: {}'.format(
+                ', '.join(sorted(clashes))))
+
+        cls._field_order = tuple(order)
+        cls._fields = frozenset(order)
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def get(self, key, default=None):
+        if key in self._fields:
+            return getattr(self, key, default)
+
+        if self._extra is None:
+            return default
+        return self._extra.get(key, default)
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            setattr(self, key, value)
+        elif self._extra is None:
+            self._extra = {key: value}
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._fields:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in self._fields:
+            return hasattr(self, key)
+
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for k in self._field_order:
+            if hasattr(self, k):
+                yield k
+
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        n = sum(1 for k in self._field_order if hasattr(self, k))
+        if self._extra is not None:
+            n += len(self._extra)
+        return n
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self.items()))
+
+    def __reduce__(self):
+        return type(self), (dict(self.items()), )
+
+    def copy(self):
+        """
+        Returns a shallow copy of the same type.
+        """
+        return type(self)(self.items())
@@ -20,12 +20,17 @@ This module provides means to work with middleware in a more convinient way.
 
 Since context is usually a nested `dict`, functions `midware.core.get_in` and
 `midware.core.assoc_in` are provided for easier manipulation of values.
+Paths that are used over and over can be compiled once with `midware.core.path`.
+Values that are expensive to compute and not always needed can be put
+with `midware.core.assoc_lazy`, so that they're computed on first read.
 
 For no-op handlers and middleware there is `midware.core.identity`.
 
 `midware.core.compose` allows for piping functions while not using any brackets,
 but `midware.core.wrap_and_call` is suited specifically for the most
-frequent one-handler-many-layers use case.
+frequent one-handler-many-layers use case. When the same layers are called
+over and over, `midware.core.Pipeline` builds them once and can be reused,
+and `midware.core.compile_chain` generates code for them.
 
 The function called `midware.core.middleware` turns generators into middleware. With
 this function the previous example turns into:
@@ -39,7 +44,8 @@ this function the previous example turns into:
         yield new_ctx
 
 Here `'wrap_smth'` stands for the name of the middleware and it's used when
-middleware is layered with `midware.core.wrap_and_call` and `verbose` is passed as `True`.
+middleware is layered with `midware.core.wrap_and_call` and `verbose` is passed as `True`
+or some other kind of instrumentation is chosen with `midware.core.instrumented`.
 If middleware is defined without the usage of generators, then the name can be set
 using `midware.core.named`. Again the following is better than the first example:
 
@@ -53,9 +59,50 @@ using `midware.core.named`. Again the following is better than the first example
             return new_ctx
 
         return handler
+
+When a layer only needs to do something before and after the handler,
+subclassing `midware.core.Layer` is cheaper than a generator, because
+nothing is created per call:
+
+    class WrapSmth(midware.core.Layer):
+        name = 'wrap_smth'
+
+        def before(self, ctx):
+            # do smth with ctx
+            return ctx
+
+        def after(self, new_ctx):
+            # do some post-processing with new_ctx
+            return new_ctx
+
+    midware.core.wrap_and_call(ctx, handler, WrapSmth())
 """
 
-_VERBOSE_MODE = False
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from types import FunctionType, MethodType
+
+from midware.context import Context
+from midware.lazy import Lazy
+from midware.persistent import PersistentMap
+
+_MAPPINGS = (PersistentMap, Context)
+"""
+Types besides `dict` that `midware.core.get_in` looks into.
+"""
+
+_instrumentation = ContextVar('midware_instrumentation', default=None)
+"""
+The `midware.core.Probe` that named layers are instrumented with while
+they are applied to a handler, or `None`. It's a context variable, so chains
+built concurrently in other threads and `asyncio` tasks are not affected.
+"""
+
+_MISSING = object()
 
 
 def get_in(d, ks, default=None):
@@ -63,17 +110,28 @@ def get_in(d, ks, default=None):
     Returns a value in a nested associative structure,
     where `ks` is a sequence of keys. Returns `None`, if the key
     is not present, or the `default` value, if supplied.
+
+    Levels can be `dict`s, `midware.context.Context`s
+    or `midware.persistent.PersistentMap`s. `midware.core.Lazy` values
+    on the way are forced.
     """
     *ks_, last = ks
     d_ = d
 
     for k in ks_:
-        if type(d_) != dict or k not in d_:
+        if type(d_) != dict and not isinstance(d_, _MAPPINGS):
+            return default
+        if k not in d_:
             return default
         d_ = d_[k]
+        if type(d_) is Lazy:
+            d_ = d_.force()
 
-    if type(d_) == dict:
-        return d_.get(last, default)
+    if type(d_) == dict or isinstance(d_, _MAPPINGS):
+        v = d_.get(last, default)
+        if type(v) is Lazy:
+            return v.force()
+        return v
 
     return default
 
@@ -83,7 +141,13 @@ def assoc_in(d, ks, v):
     Associates a value in a nested associative structure, where `ks` is a
     sequence of keys and `v` is the new value, and returns a nested structure.
     If any levels do not exist, `dict`s will be created.
+
+    If `d` is a `midware.persistent.PersistentMap`, it's not changed
+    and a new version is returned instead.
     """
+    if type(d) is not dict and isinstance(d, PersistentMap):
+        return d.assoc_in(ks, v)
+
     *ks_, last = ks
     d_ = d
 
@@ -91,11 +155,207 @@ def assoc_in(d, ks, v):
         if k not in d_:
             d_[k] = {}
         d_ = d_[k]
+        if type(d_) is Lazy:
+            d_ = d_.force()
 
     d_[last] = v
     return d
 
 
+def assoc_lazy(d, ks, fn):
+    """
+    Associates a `midware.core.Lazy` value, which is computed by calling `fn`
+    when it's first read with `midware.core.get_in`, like `assoc_in` does.
+    """
+    return assoc_in(d, ks, Lazy(fn))
+
+
+def unforced(d):
+    """
+    Returns paths of `midware.core.Lazy` values in a nested associative
+    structure that have never been forced, as tuples of keys.
+    """
+    paths = []
+    stack = [((), d)]
+
+    while stack:
+        prefix, d_ = stack.pop()
+        for k, v in d_.items():
+            ks = prefix + (k, )
+            if type(v) is Lazy:
+                if not v.forced:
+                    paths.append(ks)
+                    continue
+                v = v.force()
+            if type(v) is dict or isinstance(v, _MAPPINGS):
+                stack.append((ks, v))
+
+    return paths
+
+
+def _compile_accessors(ks):
+    """
+    Generates straight-line `get`, `set`, `delete` and `update` functions
+    for a sequence of keys `ks` and returns them in a `dict`.
+    """
+    names = ['k{}'.format(i) for i in range(len(ks))]
+    *walk, last = names
+
+    is_map = 'type({0}) is dict or isinstance({0}, _MAPPINGS)'
+
+    get = ['def get(d, default=None):']
+    for k in walk:
+        get += [
+            '    if not ({}):'.format(is_map.format('d')),
+            '        return default',
+            '    d = d.get({}, _MISSING)'.format(k),
+            '    if type(d) is Lazy:',
+            '        d = d.force()',
+        ]
+    get += [
+        '    if not ({}):'.format(is_map.format('d')),
+        '        return default',
+        '    d = d.get({}, default)'.format(last),
+        '    if type(d) is Lazy:',
+        '        return d.force()',
+        '    return d',
+    ]
+
+    def walk_creating(head, persistent):
+        lines = [
+            head,
+            '    if type(d) is not dict and isinstance(d, PersistentMap):',
+            '        return {}'.format(persistent),
+            '    d_ = d',
+        ]
+        for k in walk:
+            lines += [
+                '    if {} not in d_:'.format(k),
+                '        d_[{}] = {{}}'.format(k),
+                '    d_ = d_[{}]'.format(k),
+                '    if type(d_) is Lazy:',
+                '        d_ = d_.force()',
+            ]
+        return lines
+
+    set_ = walk_creating('def set(d, v):', 'd.assoc_in(ks, v)') + [
+        '    d_[{}] = v'.format(last),
+        '    return d',
+    ]
+
+    update = walk_creating(
+        'def update(d, f, *args, **kwargs):',
+        'd.assoc_in(ks, f(get(d), *args, **kwargs))') + [
+        '    v = d_.get({})'.format(last),
+        '    if type(v) is Lazy:',
+        '        v = v.force()',
+        '    d_[{}] = f(v, *args, **kwargs)'.format(last),
+        '    return d',
+    ]
+
+    delete = [
+        'def delete(d):',
+        '    if type(d) is not dict and isinstance(d, PersistentMap):',
+        '        return d.dissoc_in(ks)',
+        '    d_ = d',
+    ]
+    is_mutable = 'type({0}) is dict or isinstance({0}, Context)'
+    for k in walk:
+        delete += [
+            '    if not ({}):'.format(is_mutable.format('d_')),
+            '        return d',
+            '    d_ = d_.get({}, _MISSING)'.format(k),
+            '    if type(d_) is Lazy:',
+            '        d_ = d_.force()',
+        ]
+    delete += [
+        '    if {}:'.format(is_mutable.format('d_')),
+        '        d_.pop({}, None)'.format(last),
+        '    return d',
+    ]
+
+    source = '\n'.join(get + set_ + update + delete)
+    namespace = dict(
+        zip(names, ks),
+        ks=ks,
+        _MISSING=_MISSING,
+        _MAPPINGS=_MAPPINGS,
+        Lazy=Lazy,
+        Context=Context,
+        PersistentMap=PersistentMap)
+    exec(compile(source, '<midware path {!r}>'.format(ks), 'exec'), namespace)
+
+    return namespace
+
+
+class Path:
+    """
+    A sequence of keys compiled once into specialised functions, which
+    work like `midware.core.get_in` and `midware.core.assoc_in`, including
+    on `midware.persistent.PersistentMap`s, but don't parse the keys
+    and don't loop on every call:
+
+        user_id = midware.core.path('request', 'user', 'id')
+        user_id.get(ctx)
+        user_id.set(ctx, 42)
+
+    A `Path` is a sequence of its keys too, so it can be passed
+    wherever `ks` is expected.
+    """
+
+    __slots__ = ('keys', 'get', 'set', 'update', 'delete')
+
+    def __init__(self, ks):
+        ks = tuple(ks)
+        if not ks:
+            raise ValueError('a path needs at least one key')
+
+        accessors = _compile_accessors(ks)
+
+        self.keys = ks
+        self.get = accessors['get']
+        """
+        `get(d, default=None)` is the same as `get_in(d, ks, default)`.
+        """
+        self.set = accessors['set']
+        """
+        `set(d, v)` is the same as `assoc_in(d, ks, v)`.
+        """
+        self.update = accessors['update']
+        """
+        `update(d, f, *args, **kwargs)` associates the result of calling `f`
+        with the current value or `None` and extra arguments, and returns `d`.
+        """
+        self.delete = accessors['delete']
+        """
+        `delete(d)` removes the value, if it's present, and returns `d`.
+        """
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __eq__(self, other):
+        if isinstance(other, Path):
+            return self.keys == other.keys
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.keys)
+
+    def __repr__(self):
+        return 'path{!r}'.format(self.keys)
+
+
+def path(*ks):
+    """
+    Returns a `midware.core.Path` of keys `ks`.
+    """
+    return Path(ks)
+
+
 def identity(x):
     """
     A named identity function is nicer than `lambda x: x`.
@@ -125,22 +385,187 @@ def compose(*funcs):
     return wrapper
 
 
+class Probe:
+    """
+    Instrumentation that named layers call when a `ctx` goes through them.
+
+    `enter` is called before a layer starts its before section and returns
+    a token. `exit` is called with that token after the layer is done,
+    `error` being the exception that is propagating or `None`.
+
+    Probes are chosen when a chain is built, see `midware.core.instrumented`.
+    """
+
+    def enter(self, name, ctx):
+        pass
+
+    def exit(self, name, token, ctx, error):
+        pass
+
+
 def _print_inwards(middleware_name):
     """
-    Print a `middleware_name` with a right arrow
-    if `_VERBOSE_MODE` is on.
+    Print a `middleware_name` with a right arrow.
     """
-    if _VERBOSE_MODE:
-        print('{}--->'.format(middleware_name))
+    print('{}--->'.format(middleware_name))
 
 
 def _print_outwards(middleware_name):
     """
-    Print a `middleware_name` with a left arrow
-    if `_VERBOSE_MODE` is on.
+    Print a `middleware_name` with a left arrow.
+    """
+    print('<---{}'.format(middleware_name))
+
+
+class _NamesProbe(Probe):
+    """
+    Prints when layers start their before and after sections.
+    """
+
+    def enter(self, name, ctx):
+        _print_inwards(name)
+
+    def exit(self, name, token, ctx, error):
+        if error is None:
+            _print_outwards(name)
+
+
+class _TimingProbe(Probe):
+    """
+    Prints layer names and how long each layer took.
+    """
+
+    def enter(self, name, ctx):
+        _print_inwards(name)
+        return time.perf_counter_ns()
+
+    def exit(self, name, token, ctx, error):
+        if error is None:
+            print('<---{} {:.1f}us'.format(
+                name, (time.perf_counter_ns() - token) / 1000))
+
+
+class _TraceProbe(Probe):
+    """
+    Prints layer names, how long each layer took,
+    every `ctx` and every error.
     """
-    if _VERBOSE_MODE:
-        print('<---{}'.format(middleware_name))
+
+    def enter(self, name, ctx):
+        print('{}---> {!r}'.format(name, ctx))
+        return time.perf_counter_ns()
+
+    def exit(self, name, token, ctx, error):
+        print('<---{} {:.1f}us {!r}'.format(
+            name, (time.perf_counter_ns() - token) / 1000,
+            ctx if error is None else error))
+
+
+_MODES = {
+    'off': None,
+    'names': _NamesProbe(),
+    'timing': _TimingProbe(),
+    'trace': _TraceProbe(),
+}
+
+
+def _probe_for(instrument=None, verbose=False):
+    """
+    Returns the `midware.core.Probe` for an `instrument` argument, which is
+    either a mode name or a probe. `verbose` is the same as `'names'`.
+    """
+    if instrument is None:
+        instrument = 'names' if verbose else 'off'
+
+    if isinstance(instrument, str):
+        try:
+            return _MODES[instrument]
+        except KeyError:
+            raise ValueError(
+                'unknown instrumentation mode: {!r}'.format(instrument))
+
+    return instrument
+
+
+@contextmanager
+def instrumented(instrument):
+    """
+    Named layers applied to handlers within this context manager are
+    instrumented with `instrument`, which is a `midware.core.Probe` or one of:
+
+    - `'off'` adds nothing to the layers at all,
+    - `'names'` prints when layers start their before and after sections,
+    - `'timing'` also prints how long each layer took,
+    - `'trace'` also prints every `ctx` and every error.
+
+    `midware.core.Pipeline` and `midware.core.wrap_and_call` take the same
+    `instrument` argument, so this is only needed for chains built by hand.
+    """
+    token = _instrumentation.set(_probe_for(instrument))
+    try:
+        yield
+    finally:
+        _instrumentation.reset(token)
+
+
+def _probed(probe, name, handler):
+    """
+    Returns a handler that calls `probe` around the `handler`.
+    """
+    enter = probe.enter
+    exit_ = probe.exit
+
+    def probed_handler(ctx):
+        token = enter(name, ctx)
+
+        try:
+            new_ctx = handler(ctx)
+        except BaseException as e:
+            exit_(name, token, ctx, e)
+            raise
+
+        exit_(name, token, new_ctx, None)
+
+        return new_ctx
+
+    return probed_handler
+
+
+def _instrument(name, handler):
+    """
+    Instruments a `handler` of a layer called `name` with the current probe.
+    Without a probe the `handler` is returned as is.
+    """
+    probe = _instrumentation.get()
+    if probe is None:
+        return handler
+
+    return _probed(probe, name, handler)
+
+
+def _take_name(wrapper, wrapped):
+    """
+    Makes `wrapper` look like `wrapped` to `help` and to `pickle`, so that
+    middleware decorated at the module level is pickled by reference.
+    """
+    for attr in ('__module__', '__name__', '__qualname__', '__doc__'):
+        try:
+            setattr(wrapper, attr, getattr(wrapped, attr))
+        except AttributeError:
+            pass
+
+    return wrapper
+
+
+def _ctx_kwargs(ctx, ctx_args):
+    """
+    Returns keyword arguments taken from `ctx`, where `ctx_args` maps
+    argument names to paths, as a mapping or pairs.
+    """
+    if hasattr(ctx_args, 'items'):
+        ctx_args = ctx_args.items()
+
+    return {k: get_in(ctx, ks_) for k, ks_ in ctx_args}
 
 
 def mw_from_cm(name, cm_constructor, ks=None, ctx_args={}, **kwargs):
@@ -151,22 +576,63 @@ def mw_from_cm(name, cm_constructor, ks=None, ctx_args={}, **kwargs):
 
     def new_middleware(handler):
         def new_handler(ctx):
-            _print_inwards(name)
-
-            ctx_kwargs = {}
-            for k, ks_ in ctx_args:
-                ctx_kwargs[k] = get_in(ctx, ks_)
+            ctx_kwargs = _ctx_kwargs(ctx, ctx_args)
 
             with cm_constructor(**ctx_kwargs, **kwargs) as v:
                 if ks:
                     assoc_in(ctx, ks, v)
                 new_ctx = handler(ctx)
 
-            _print_outwards(name)
-
             return new_ctx
 
-        return new_handler
+        return _instrument(name, new_handler)
+
+    return new_middleware
+
+
+def resource(cm_constructor, ks=None, ctx_args={}, **kwargs):
+    """
+    Describes a context manager for `midware.core.mw_from_cms`. Arguments
+    are the same as the ones of `midware.core.mw_from_cm` after the name.
+    """
+    return cm_constructor, ks, ctx_args, kwargs
+
+
+def mw_from_cms(name, *resources):
+    """
+    Returns one layer that enters context managers described by
+    `midware.core.resource` left to right, associates every resource with
+    its `ks` and calls the handler, same as layers of `mw_from_cm` would.
+    They are kept in one `contextlib.ExitStack`, so they are exited in
+    reverse order and every one of them sees an exception if there's one.
+    Paths are compiled once, when the layer is made.
+    """
+
+    specs = []
+    for cm_constructor, ks, ctx_args, kwargs in resources:
+        if hasattr(ctx_args, 'items'):
+            ctx_args = ctx_args.items()
+        specs.append((cm_constructor, Path(ks).set if ks else None,
+                      [(k, Path(ks_).get) for k, ks_ in ctx_args], kwargs))
+
+    def new_middleware(handler):
+        def new_handler(ctx):
+            with ExitStack() as stack:
+                enter = stack.enter_context
+                for cm_constructor, set_, ctx_args, kwargs in specs:
+                    if ctx_args:
+                        v = enter(
+                            cm_constructor(
+                                **{k: get(ctx)
+                                   for k, get in ctx_args}, **kwargs))
+                    else:
+                        v = enter(cm_constructor(**kwargs))
+                    if set_ is not None:
+                        set_(ctx, v)
+
+                return handler(ctx)
+
+        return _instrument(name, new_handler)
 
     return new_middleware
 
@@ -184,21 +650,19 @@ def middleware(name, *args, **kwargs):
     def new_annotate(g_fn):
         def new_middleware(handler):
             def new_handler(ctx):
-                _print_inwards(name)
-
                 g = g_fn(ctx, *args, **kwargs)
 
                 changed_ctx = next(g)
                 new_ctx = handler(changed_ctx)
                 last_ctx = g.send(new_ctx)
 
-                _print_outwards(name)
-
                 return last_ctx
 
-            return new_handler
+            return _instrument(name, new_handler)
+
+        new_middleware._midware_generator = (name, g_fn, args, kwargs)
 
-        return new_middleware
+        return _take_name(new_middleware, g_fn)
 
     return new_annotate
 
@@ -212,36 +676,641 @@ def named(name):
 
     def new_annotate(mware):
         def new_middleware(handler):
+            return _instrument(name, mware(handler))
 
-            new_handler = mware(handler)
+        return _take_name(new_middleware, mware)
 
-            def verbose_handler(ctx):
-                _print_inwards(name)
+    return new_annotate
 
-                new_ctx = new_handler(ctx)
 
-                _print_outwards(name)
+class Layer:
+    """
+    Middleware defined by a `before` method, which gets the `ctx` and returns
+    the one passed inwards, and an `after` method, which gets the result
+    of the inner handler and returns the one passed outwards. Either of them
+    can be left out. Subclasses set `name` or are named after the class.
+
+    Layers are built into chains without creating anything per call, so
+    one instance serves all calls at once and anything `after` needs to know
+    from `before` has to be kept in the `ctx`. Settings can be kept on the
+    instance, and in `__slots__` too. `after` isn't called when an inner
+    layer or the handler raises.
+
+    A layer is middleware itself, so it can be used wherever other
+    middleware is used.
+    """
 
-                return new_ctx
+    __slots__ = ('__weakref__', )
 
-            return verbose_handler
+    name = 'Layer'
 
-        return new_middleware
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'name' not in cls.__dict__:
+            cls.name = cls.__name__
 
-    return new_annotate
+    def before(self, ctx):
+        return ctx
 
+    def after(self, new_ctx):
+        return new_ctx
 
-def wrap_and_call(ctx, handler, *middleware, verbose=False):
+    def __call__(self, handler):
+        before = self.before
+        after = self.after
+
+        def new_handler(ctx):
+            return after(handler(before(ctx)))
+
+        return _instrument(self.name, new_handler)
+
+
+class _WeakLayer(Layer):
+    """
+    Stands in for a layer in chains kept by `midware.core.ChainCache`
+    and calls its `before` and `after` through a weak reference,
+    so that the chain doesn't keep it alive.
+    """
+
+    __slots__ = ('name', 'before', 'after')
+
+    def __init__(self, layer):
+        cls = type(layer)
+        ref = weakref.ref(layer)
+        self.name = layer.name
+        self.before = None if cls.before is Layer.before else _weak_method(
+            ref, cls.before)
+        self.after = None if cls.after is Layer.after else _weak_method(
+            ref, cls.after)
+
+    def __call__(self, handler):
+        before = self.before or identity
+        after = self.after or identity
+
+        def new_handler(ctx):
+            return after(handler(before(ctx)))
+
+        return _instrument(self.name, new_handler)
+
+
+def _weak_method(ref, fn):
+    def method(ctx):
+        return fn(ref(), ctx)
+
+    return method
+
+
+def _step(mw):
+    """
+    Returns how `midware.core._flatten` runs `mw`, or `None` if it can't.
+    Generator middleware is a name, a generator function and its arguments,
+    a `midware.core.Layer` is a name, `None` and its `before` and `after`,
+    which are `None` if they do nothing.
+    """
+    if isinstance(mw, Layer):
+        cls = type(mw)
+        return (mw.name, None,
+                None if cls.before is Layer.before else mw.before,
+                None if cls.after is Layer.after else mw.after)
+
+    return getattr(mw, '_midware_generator', None)
+
+
+_FLAT_MIN = 4
+"""
+Runs of fewer adjacent generator middleware and layers than this are nested
+by `midware.core._build`, since a loop only pays off for longer ones.
+"""
+
+
+def _flatten(handler, steps):
+    """
+    Returns a handler that runs a sequence of middleware `steps`
+    around the `handler` in a loop instead of nesting them. Every generator
+    is advanced to its first `yield` and every `before` is called in order,
+    then the `handler` is called and the results are sent back to generators
+    and `after`s in reverse order.
+    """
+    probe = _instrumentation.get()
+    if probe is not None:
+        return _probed_flatten(probe, handler, steps)
+
+    if all(g_fn is None for _, g_fn, *_ in steps):
+        return _layered(handler, steps)
+    if all(g_fn is not None for _, g_fn, *_ in steps):
+        return _generators(handler, steps)
+
+    back_steps = [g_fn is None for _, g_fn, *_ in reversed(steps)]
+
+    def flat_handler(ctx):
+        backs = []
+        push = backs.append
+
+        try:
+            for _, g_fn, args, kwargs in steps:
+                if g_fn is None:
+                    if args is not None:
+                        ctx = args(ctx)
+                    push(kwargs)
+                    continue
+
+                g = g_fn(ctx, *args, **kwargs)
+                push(g)
+                ctx = next(g)
+
+            ctx = handler(ctx)
+
+            for back, is_layer in zip(reversed(backs), back_steps):
+                if not is_layer:
+                    ctx = back.send(ctx)
+                elif back is not None:
+                    ctx = back(ctx)
+        except BaseException:
+            for back, (_, g_fn, *_) in zip(reversed(backs),
+                                           steps[len(backs) - 1::-1]):
+                if g_fn is not None:
+                    back.close()
+            raise
+
+        return ctx
+
+    return flat_handler
+
+
+def _starter(g_fn, args, kwargs):
+    """
+    Returns a function that starts the generator `g_fn` with a `ctx`
+    and its arguments.
+    """
+    if not args and not kwargs:
+        return g_fn
+
+    def start(ctx):
+        return g_fn(ctx, *args, **kwargs)
+
+    return start
+
+
+def _generators(handler, steps):
+    """
+    Same as `midware.core._flatten` for `steps` that are all generators.
+    """
+    starts = [
+        _starter(g_fn, args, kwargs) for _, g_fn, args, kwargs in steps
+    ]
+
+    def generators_handler(ctx):
+        gens = []
+        push = gens.append
+
+        try:
+            for start in starts:
+                g = start(ctx)
+                push(g)
+                ctx = next(g)
+
+            ctx = handler(ctx)
+
+            for g in reversed(gens):
+                ctx = g.send(ctx)
+        except BaseException:
+            for g in reversed(gens):
+                g.close()
+            raise
+
+        return ctx
+
+    return generators_handler
+
+
+def _layered(handler, steps):
+    """
+    Same as `midware.core._flatten` for `steps` that are all layers.
+    """
+    befores = [before for _, _, before, _ in steps if before is not None]
+    afters = [after for _, _, _, after in reversed(steps) if after is not None]
+
+    def layered_handler(ctx):
+        for before in befores:
+            ctx = before(ctx)
+
+        ctx = handler(ctx)
+
+        for after in afters:
+            ctx = after(ctx)
+
+        return ctx
+
+    return layered_handler
+
+
+def _probed_flatten(probe, handler, steps):
+    """
+    Same as `midware.core._flatten`, but calls `probe` around every step.
+    """
+    enter = probe.enter
+    exit_ = probe.exit
+    names = [name for name, *_ in steps]
+
+    def probed_flat_handler(ctx):
+        backs = []
+        tokens = []
+
+        try:
+            for name, g_fn, args, kwargs in steps:
+                tokens.append(enter(name, ctx))
+                if g_fn is None:
+                    if args is not None:
+                        ctx = args(ctx)
+                    backs.append(kwargs)
+                    continue
+
+                g = g_fn(ctx, *args, **kwargs)
+                backs.append(g)
+                ctx = next(g)
+
+            ctx = handler(ctx)
+
+            for name, g_fn, *_ in reversed(steps):
+                back = backs.pop()
+                if g_fn is not None:
+                    ctx = back.send(ctx)
+                elif back is not None:
+                    ctx = back(ctx)
+                exit_(name, tokens.pop(), ctx, None)
+        except BaseException as e:
+            while tokens:
+                i = len(tokens) - 1
+                if len(backs) == len(tokens):
+                    back = backs.pop()
+                    if steps[i][1] is not None:
+                        back.close()
+                exit_(names[i], tokens.pop(), ctx, e)
+            raise
+
+        return ctx
+
+    return probed_flat_handler
+
+
+def _fuse(handler, steps):
+    """
+    Same as `midware.core._flatten`, but generates the source of one function
+    that calls every step in turn, so that there's no loop at all.
+    """
+    probe = _instrumentation.get()
+    if probe is not None:
+        return _probed_flatten(probe, handler, steps)
+
+    namespace = {'handler': handler}
+    forth = []
+    back = []
+    gens = []
+
+    for i, (_, g_fn, args, kwargs) in enumerate(steps):
+        if g_fn is None:
+            if args is not None:
+                namespace['before{}'.format(i)] = args
+                forth.append('ctx = before{}(ctx)'.format(i))
+            if kwargs is not None:
+                namespace['after{}'.format(i)] = kwargs
+                back.append('ctx = after{}(ctx)'.format(i))
+            continue
+
+        g = 'g{}'.format(i)
+        namespace['g_fn{}'.format(i)] = g_fn
+        call = ['ctx']
+        if args:
+            namespace['args{}'.format(i)] = args
+            call.append('*args{}'.format(i))
+        if kwargs:
+            namespace['kwargs{}'.format(i)] = kwargs
+            call.append('**kwargs{}'.format(i))
+
+        gens.append(g)
+        forth += [
+            '{} = g_fn{}({})'.format(g, i, ', '.join(call)),
+            'ctx = next({})'.format(g),
+        ]
+        back.append('ctx = {}.send(ctx)'.format(g))
+
+    body = forth + ['ctx = handler(ctx)'] + back[::-1]
+
+    if gens:
+        source = ['def fused_handler(ctx):']
+        source += ['    {} = None'.format(g) for g in gens]
+        source += ['    try:'] + ['        ' + line for line in body]
+        source += ['    except BaseException:']
+        for g in reversed(gens):
+            source += [
+                '        if {} is not None:'.format(g),
+                '            {}.close()'.format(g),
+            ]
+        source += ['        raise', '    return ctx']
+    else:
+        source = ['def fused_handler(ctx):']
+        source += ['    ' + line for line in body] + ['    return ctx']
+
+    exec(
+        compile('\n'.join(source), '<midware chain of {}>'.format(len(steps)),
+                'exec'), namespace)
+
+    return namespace['fused_handler']
+
+
+def _build(handler, middleware, flatten=_flatten, flat_min=_FLAT_MIN):
+    """
+    Layers `middleware` left to right around the `handler`
+    and returns the outermost handler.
+
+    Runs of at least `flat_min` adjacent middleware made by
+    `midware.core.middleware` and layers are run by one handler made by
+    `flatten`, so deep chains don't grow the call stack, and shorter ones
+    are nested. Named layers are instrumented with the current probe.
+    """
+    steps = []
+    run = []
+
+    for mw in reversed(middleware):
+        step = _step(mw)
+        if step is not None:
+            steps.append(step)
+            run.append(mw)
+            continue
+
+        if steps:
+            handler = _run(handler, steps, run, flatten, flat_min)
+            steps = []
+            run = []
+        handler = mw(handler)
+
+    if steps:
+        handler = _run(handler, steps, run, flatten, flat_min)
+
+    return handler
+
+
+def _run(handler, steps, run, flatten, flat_min):
+    """
+    Layers a `run` of middleware with `steps`, both innermost first,
+    around the `handler` with `flatten` or by nesting them.
+    """
+    if len(steps) >= flat_min:
+        return flatten(handler, steps[::-1])
+
+    for mw in run:
+        handler = mw(handler)
+
+    return handler
+
+
+def _compile(handler, middleware):
+    return _build(handler, middleware, flatten=_fuse, flat_min=1)
+
+
+def _build_instrumented(build, handler, middleware, probe):
+    """
+    Calls `build` with named layers instrumented by `probe`.
+    """
+    token = _instrumentation.set(probe)
+    try:
+        return build(handler, middleware)
+    finally:
+        _instrumentation.reset(token)
+
+
+class Pipeline:
+    """
+    A `handler` layered with `middleware` left to right once, so that
+    it can be called with many `ctx` values without rebuilding the chain.
+    `Pipeline(handler, *middleware)(ctx)` is the same as
+    `wrap_and_call(ctx, handler, *middleware)`.
+
+    Setting `verbose` to `True` prints when handlers start their
+    before and after sections. Other kinds of instrumentation can be
+    chosen with `instrument`, see `midware.core.instrumented`. Either way,
+    it's decided once when the chain is built.
+    """
+
+    def __init__(self, handler, *middleware, verbose=False, instrument=None):
+        self.handler = handler
+        self.middleware = middleware
+        self.probe = _probe_for(instrument, verbose)
+        self._wrapped = _build_instrumented(_build, handler, middleware,
+                                            self.probe)
+
+    def __call__(self, ctx):
+        return self._wrapped(ctx)
+
+    def __reduce__(self):
+        return _restore_pipeline, (type(self), self.handler, self.middleware,
+                                   self.probe)
+
+
+def compile_chain(handler, *middleware, verbose=False, instrument=None):
+    """
+    Layers `middleware` left to right around the `handler` like
+    `midware.core.Pipeline` does, but generates the code of one function
+    for every run of adjacent generator middleware and layers,
+    which calls them in turn without a loop or nested calls.
+    Other middleware is layered around those functions as usual.
+
+    Building takes longer than it does for a `midware.core.Pipeline`,
+    so it pays off for chains that are called many times.
+    `verbose` and `instrument` are the same as in `midware.core.Pipeline`,
+    instrumented chains are not compiled.
+    """
+    probe = _probe_for(instrument, verbose)
+
+    return _build_instrumented(_compile, handler, middleware, probe)
+
+
+def _restore_pipeline(cls, handler, middleware, probe):
+    """
+    Builds a pipeline again after it's been unpickled.
+    """
+    return cls(handler, *middleware, instrument=probe)
+
+
+def _weak_ref(x, callback=None):
+    """
+    Returns a weak reference to `x`. A bound method is made anew every time
+    it's looked up, so for one the reference is to its object and function.
+    """
+    if type(x) is MethodType:
+        return weakref.WeakMethod(x, callback)
+    return weakref.ref(x, callback)
+
+
+def _handler_id(handler):
+    """
+    Returns what tells handlers apart in `midware.core.ChainCache` keys,
+    which for a bound method is the identity of its object and function.
+    """
+    if type(handler) is MethodType:
+        return id(handler.__self__), id(handler.__func__)
+    return id(handler)
+
+
+def _weak_handler(handler):
+    """
+    Returns a handler that calls `handler` through a weak reference,
+    so that a chain built around it does not keep it alive.
+    """
+    ref = _weak_ref(handler)
+
+    def weak_handler(ctx):
+        return ref()(ctx)
+
+    return weak_handler
+
+
+class ChainCache:
+    """
+    A bounded cache of built chains used by `midware.core.wrap_and_call`.
+
+    Chains are keyed by the identity of the handler, or of the object
+    and the function of a bound method, of every middleware
+    and of the `midware.core.Probe` they are instrumented with.
+    They are built around a weak reference to the handler, layers are called
+    through weak references too and the key objects are only held weakly,
+    so a discarded handler or middleware frees its chain. Chains with other
+    middleware that isn't a function, like `midware.cache` and
+    `midware.limit` instances or bound methods, would keep it alive,
+    so they are never cached, and neither are callables that can't
+    be weakly referenced.
+
+    `eviction` is either `'lru'` or `'fifo'`. Setting `maxsize` to `0`
+    turns caching off. `build` is the function that layers middleware around
+    a handler, it's only replaced by chains of a different kind,
+    like the ones in `midware.aio`.
+    """
+
+    def __init__(self, maxsize=256, eviction='lru', build=None):
+        if eviction not in ('lru', 'fifo'):
+            raise ValueError('unknown eviction policy: {!r}'.format(eviction))
+
+        self.maxsize = maxsize
+        self.eviction = eviction
+        self.build = build or _build
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._dead = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _forget(self, key):
+        # Weakref callbacks may fire in the middle of an update made
+        # by this very thread, so dead keys are only queued if the lock
+        # is taken, and get purged before the next lookup.
+        self._dead.append(key)
+        if self._lock.acquire(blocking=False):
+            try:
+                self._purge()
+            finally:
+                self._lock.release()
+
+    def _purge(self):
+        while self._dead:
+            self._entries.pop(self._dead.pop(), None)
+
+    def get(self, handler, middleware, probe=None):
+        """
+        Returns a chain of `middleware` around the `handler` instrumented
+        with `probe`, building and caching it if needed.
+        """
+        if not self.maxsize:
+            return _build_instrumented(self.build, handler, middleware, probe)
+
+        key = (id(probe), _handler_id(handler)) + tuple(map(id, middleware))
+
+        with self._lock:
+            self._purge()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                if self.eviction == 'lru':
+                    self._entries.move_to_end(key)
+                return entry[1]
+
+        weak = []
+        for mw in middleware:
+            if isinstance(mw, Layer):
+                mw = _WeakLayer(mw)
+            elif type(mw) is not FunctionType:
+                return _build_instrumented(self.build, handler, middleware,
+                                           probe)
+            weak.append(mw)
+
+        def forget(_, key=key):
+            self._forget(key)
+
+        keep = middleware
+        if probe is not None:
+            keep += (probe, )
+
+        try:
+            refs = (_weak_ref(handler, forget), ) + tuple(
+                weakref.ref(x, forget) for x in keep)
+        except TypeError:
+            return _build_instrumented(self.build, handler, middleware, probe)
+
+        chain = _build_instrumented(self.build, _weak_handler(handler),
+                                    tuple(weak), probe)
+
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (refs, chain)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return chain
+
+    def clear(self):
+        """
+        Drops all chains and resets the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._dead.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        """
+        Returns counters and sizes as a `dict`.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+        }
+
+
+chain_cache = ChainCache()
+"""
+The `midware.core.ChainCache` used by `midware.core.wrap_and_call`.
+"""
+
+
+def wrap_and_call(ctx, handler, *middleware, verbose=False, instrument=None):
     """
     This function layers `middleware` left to right around
     the `handler` and calls it all with `ctx` as an argument.
     
     Setting `verbose` to `True` prints when handlers start their
-    before and after sections.
-    """
-    global _VERBOSE_MODE
-    _VERBOSE_MODE = verbose
+    before and after sections. Other kinds of instrumentation can be
+    chosen with `instrument`, see `midware.core.instrumented`.
 
-    middleware_ = list(middleware)
+    Built chains are kept in `midware.core.chain_cache`, so calling
+    the same handler and middleware again doesn't rebuild the chain.
+    """
+    probe = _probe_for(instrument, verbose)
 
-    return compose(*reversed(middleware_))(handler)(ctx)
+    return chain_cache.get(handler, middleware, probe)(ctx)
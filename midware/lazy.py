@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Values that are computed when they're first read.
+
+`midware.lazy.Lazy` is what `midware.core.assoc_lazy` puts into a `ctx`.
+It's used as `midware.core.Lazy` and lives here so that
+`midware.persistent` can force it too.
+"""
+
+import threading
+
+_MISSING = object()
+
+
+class Lazy:
+    """
+    A value that is computed by calling `fn` when it's first needed.
+    `midware.core.get_in` and `midware.core.Path.get` force lazy values
+    they come across, other ways of reading a `ctx` return them as they are.
+    `midware.core.assoc_in` and other `Path` functions force lazy levels
+    on the way to the last key, and `Path.update` forces the value it's passed.
+
+    `fn` is called once even if the value is forced by several threads
+    at once. If it raises, the value stays unforced.
+    """
+
+    __slots__ = ('_fn', '_value', '_lock')
+
+    def __init__(self, fn):
+        self._fn = fn
+        self._value = _MISSING
+        self._lock = threading.Lock()
+
+    @property
+    def forced(self):
+        return self._value is not _MISSING
+
+    def force(self):
+        """
+        Returns the value, computing it if it's not been computed yet.
+        """
+        value = self._value
+        if value is _MISSING:
+            with self._lock:
+                if self._value is _MISSING:
+                    self._value = self._fn()
+                    self._fn = None
+                value = self._value
+
+        return value
+
+    def __repr__(self):
+        if self._value is _MISSING:
+            return 'Lazy({!r})'.format(self._fn)
+        return 'Lazy(forced={!r})'.format(self._value)
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control for chains.
+
+A `midware.limit.ConcurrencyLimit` is middleware that lets a limited number
+of calls through at once. The limit adapts to latency: it grows by one
+every time about `limit` calls finish without getting slower than
+the fastest ones seen recently and shrinks by a factor when they do,
+so it settles where throughput stops growing and latency starts to:
+
+    limit = midware.limit.ConcurrencyLimit('admission', policy='queue',
+                                           priority=('request', 'priority'))
+    pipeline = midware.core.Pipeline(handler, limit, *middleware)
+
+Calls over the limit are either rejected with `midware.limit.Overloaded`
+or queued. It works in chains of `midware.core` and `midware.aio` alike.
+"""
+
+import asyncio
+import heapq
+import inspect
+import itertools
+import threading
+import time
+
+from midware import aio, core
+from midware.core import Path
+
+_POLICIES = ('reject', 'queue')
+
+
+class Overloaded(Exception):
+    """
+    Raised when a call is not let through a `midware.limit.ConcurrencyLimit`.
+    """
+
+
+class _Waiter:
+    """
+    A queued call, `wake` is called when it's let through.
+    Threads wait for the `event`.
+    """
+
+    __slots__ = ('wake', 'event', 'granted', 'cancelled')
+
+    def __init__(self, wake, event=None):
+        self.wake = wake
+        self.event = event
+        self.granted = False
+        self.cancelled = False
+
+
+class ConcurrencyLimit:
+    """
+    Middleware that caps calls of the inner chain in flight at `limit`,
+    which starts at `initial_limit` and stays between `min_limit`
+    and `max_limit`.
+
+    After every call the latency is compared with the baseline, the lowest
+    latency of the last `window` to `2 * window` calls. The limit grows
+    by `1 / limit` if the latency is within `tolerance` times the baseline
+    and at least half of the limit is in use, and it's multiplied by
+    `backoff` if it's not or if the inner chain raises `Overloaded`.
+    Calls that raise anything else don't change the limit, since
+    failing fast says nothing about how loaded the inner chain is.
+
+    With the `'reject'` policy calls over the limit raise `Overloaded`.
+    With `'queue'` they wait, the ones with the lowest value of the
+    `priority` path first, then in order of arrival. At most `max_queue`
+    calls wait and each for at most `timeout` seconds, and `Overloaded`
+    is raised when there's no room or time left.
+    """
+
+    def __init__(self,
+                 name,
+                 initial_limit=16,
+                 min_limit=1,
+                 max_limit=1000,
+                 policy='reject',
+                 priority=None,
+                 max_queue=None,
+                 timeout=None,
+                 tolerance=2.0,
+                 backoff=0.9,
+                 window=100):
+        if policy not in _POLICIES:
+            raise ValueError('unknown policy: {!r}'.format(policy))
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError('expected 1 <= min_limit <= initial_limit '
+                             '<= max_limit')
+
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.policy = policy
+        self.priority = None if priority is None else (
+            priority if isinstance(priority, Path) else Path(priority))
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.window = window
+
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._limit = float(initial_limit)
+        self._baseline = None
+        self._window_min = None
+        self._samples = 0
+        self._queue = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        """
+        The current limit of calls in flight.
+        """
+        return int(self._limit)
+
+    def _adapt(self, latency):
+        """
+        Updates the limit after a call that took `latency` nanoseconds,
+        or one that was overloaded if it's `None`. Called with the lock held.
+        """
+        if latency is not None:
+            if self._window_min is None or latency < self._window_min:
+                self._window_min = latency
+            baseline = self._window_min
+            if self._baseline is not None and self._baseline < baseline:
+                baseline = self._baseline
+
+            self._samples += 1
+            if self._samples >= self.window:
+                self._baseline = self._window_min
+                self._window_min = None
+                self._samples = 0
+
+        if latency is None or latency > self.tolerance * baseline:
+            self._limit = max(self.min_limit, self._limit * self.backoff)
+        elif self.in_flight * 2 >= self._limit:
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+    def _grant(self):
+        """
+        Lets queued calls through while there's room. Called with the lock held.
+        """
+        while self._queue and self.in_flight < int(self._limit):
+            waiter = heapq.heappop(self._queue)[2]
+            if waiter.cancelled:
+                continue
+            self.queued -= 1
+            self.in_flight += 1
+            self.admitted += 1
+            waiter.granted = True
+            waiter.wake()
+
+    def _admit(self, ctx, make_waiter):
+        """
+        Returns `None` if the call is let through right away,
+        or a `_Waiter` that's been queued.
+        """
+        with self._lock:
+            if self.in_flight < int(self._limit) and not self.queued:
+                self.in_flight += 1
+                self.admitted += 1
+                return None
+
+            if self.policy == 'reject' or (self.max_queue is not None and
+                                           self.queued >= self.max_queue):
+                self.rejected += 1
+                raise Overloaded('{}: {} calls in flight'.format(
+                    self.name, self.in_flight))
+
+            priority = 0 if self.priority is None else self.priority.get(
+                ctx, 0)
+            waiter = make_waiter()
+            heapq.heappush(self._queue, (priority, next(self._order), waiter))
+            self.queued += 1
+            return waiter
+
+    def _give_up(self, waiter):
+        """
+        Takes a waiter that stopped waiting out of the queue and returns
+        whether it had been let through by then.
+        """
+        with self._lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            self.queued -= 1
+            self.rejected += 1
+            return False
+
+    def _release(self, latency):
+        with self._lock:
+            self._adapt(latency)
+            self.in_flight -= 1
+            self._grant()
+
+    def _abandon(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._grant()
+
+    def _timed_out(self):
+        return Overloaded('{}: waited for more than {}s'.format(
+            self.name, self.timeout))
+
+    def __call__(self, handler):
+        if inspect.iscoroutinefunction(handler):
+            return aio._instrument(self.name, self._async_handler(handler))
+
+        return core._instrument(self.name, self._handler(handler))
+
+    def _handler(self, handler):
+        def new_handler(ctx):
+            waiter = self._admit(ctx, _thread_waiter)
+            if waiter is not None and not waiter.event.wait(self.timeout):
+                if not self._give_up(waiter):
+                    raise self._timed_out()
+
+            start = time.perf_counter_ns()
+            try:
+                new_ctx = handler(ctx)
+            except Overloaded:
+                self._release(None)
+                raise
+            except BaseException:
+                self._abandon()
+                raise
+
+            self._release(time.perf_counter_ns() - start)
+            return new_ctx
+
+        return new_handler
+
+    def _async_handler(self, handler):
+        async def new_handler(ctx):
+            future = None
+
+            def make_waiter():
+                nonlocal future
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                return _Waiter(
+                    lambda: loop.call_soon_threadsafe(_resolve, future))
+
+            waiter = self._admit(ctx, make_waiter)
+            if waiter is not None:
+                try:
+                    await asyncio.wait_for(future, self.timeout)
+                except asyncio.TimeoutError:
+                    if not self._give_up(waiter):
+                        raise self._timed_out() from None
+                except BaseException:
+                    if self._give_up(waiter):
+                        self._abandon()
+                    raise
+
+            start = time.perf_counter_ns()
+            try:
+                new_ctx = await handler(ctx)
+            except Overloaded:
+                self._release(None)
+                raise
+            except BaseException:
+                self._abandon()
+                raise
+
+            self._release(time.perf_counter_ns() - start)
+            return new_ctx
+
+        return new_handler
+
+    def info(self):
+        """
+        Returns the current limit, calls in flight and queued,
+        and counters of admitted and rejected calls as a `dict`.
+        """
+        with self._lock:
+            return {
+                'limit': int(self._limit),
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+            }
+
+
+def _thread_waiter():
+    event = threading.Event()
+    return _Waiter(event.set, event)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
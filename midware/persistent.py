@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent map for contexts that are copied a lot.
+
+`midware.persistent.PersistentMap` is an immutable mapping. Changing it
+returns a new version, which shares everything that didn't change with the
+old one, so keeping snapshots of a `ctx` or handing it to parallel branches
+doesn't need `copy.deepcopy`:
+
+    ctx = PersistentMap.from_dict({'request': {'user': 'alice'}})
+    new_ctx = midware.core.assoc_in(ctx, ('request', 'user'), 'bob')
+
+    midware.core.get_in(ctx, ('request', 'user'))      # 'alice'
+    midware.core.get_in(new_ctx, ('request', 'user'))  # 'bob'
+
+`midware.core.get_in` and `midware.core.assoc_in` work with it as they do with
+`dict`s, except that `assoc_in` returns the new version instead of changing
+its argument. Nested levels created by `assoc_in` are persistent maps too.
+
+It's a hash array mapped trie, so lookups and updates take O(log n) time.
+"""
+
+from collections.abc import Mapping
+
+from midware.lazy import Lazy
+
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_HASH_MASK = (1 << 64) - 1
+
+_NODE = object()
+"""
+Marks an entry of a node that holds a subnode instead of a key.
+"""
+
+_MISSING = object()
+
+try:
+    _popcount = int.bit_count
+except AttributeError:
+
+    def _popcount(x):
+        return bin(x).count('1')
+
+
+def _hash(key):
+    return hash(key) & _HASH_MASK
+
+
+class _BitmapNode:
+    """
+    A trie node with up to 32 entries. `array` holds a key and a value
+    for every set bit of `bitmap`, or `_NODE` and a subnode.
+    """
+
+    __slots__ = ('bitmap', 'array')
+
+    def __init__(self, bitmap, array):
+        self.bitmap = bitmap
+        self.array = array
+
+    def get(self, key, h, shift, default):
+        bit = 1 << ((h >> shift) & _MASK)
+        if not self.bitmap & bit:
+            return default
+
+        i = 2 * _popcount(self.bitmap & (bit - 1))
+        k = self.array[i]
+        if k is _NODE:
+            return self.array[i + 1].get(key, h, shift + _BITS, default)
+        if k is key or k == key:
+            return self.array[i + 1]
+
+        return default
+
+    def assoc(self, key, value, h, shift):
+        """
+        Returns a new node with `key` associated with `value`
+        and whether the key was added.
+        """
+        bit = 1 << ((h >> shift) & _MASK)
+        i = 2 * _popcount(self.bitmap & (bit - 1))
+        array = self.array
+
+        if not self.bitmap & bit:
+            return _BitmapNode(self.bitmap | bit,
+                               array[:i] + (key, value) + array[i:]), True
+
+        k, v = array[i], array[i + 1]
+
+        if k is _NODE:
+            node, added = v.assoc(key, value, h, shift + _BITS)
+            if node is v:
+                return self, False
+            return _BitmapNode(self.bitmap, array[:i + 1] + (node, ) +
+                               array[i + 2:]), added
+
+        if k is key or k == key:
+            if v is value:
+                return self, False
+            return _BitmapNode(self.bitmap, array[:i + 1] + (value, ) +
+                               array[i + 2:]), False
+
+        node = _pair(shift + _BITS, k, v, _hash(k), key, value, h)
+        return _BitmapNode(self.bitmap,
+                           array[:i] + (_NODE, node) + array[i + 2:]), True
+
+    def dissoc(self, key, h, shift):
+        """
+        Returns a new node without `key`, or `None` if it would be empty,
+        and whether the key was removed.
+        """
+        bit = 1 << ((h >> shift) & _MASK)
+        if not self.bitmap & bit:
+            return self, False
+
+        i = 2 * _popcount(self.bitmap & (bit - 1))
+        array = self.array
+        k, v = array[i], array[i + 1]
+
+        if k is _NODE:
+            node, removed = v.dissoc(key, h, shift + _BITS)
+            if not removed:
+                return self, False
+            if node is not None:
+                return _BitmapNode(self.bitmap, array[:i + 1] + (node, ) +
+                                   array[i + 2:]), True
+        elif not (k is key or k == key):
+            return self, False
+
+        if self.bitmap == bit:
+            return None, True
+
+        return _BitmapNode(self.bitmap ^ bit, array[:i] + array[i + 2:]), True
+
+    def items(self):
+        array = self.array
+        for i in range(0, len(array), 2):
+            if array[i] is _NODE:
+                yield from array[i + 1].items()
+            else:
+                yield array[i], array[i + 1]
+
+
+class _CollisionNode:
+    """
+    A node for keys with equal 64-bit hashes.
+    """
+
+    __slots__ = ('hash', 'array')
+
+    def __init__(self, h, array):
+        self.hash = h
+        self.array = array
+
+    def _find(self, key):
+        array = self.array
+        for i in range(0, len(array), 2):
+            k = array[i]
+            if k is key or k == key:
+                return i
+        return -1
+
+    def get(self, key, h, shift, default):
+        if h == self.hash:
+            i = self._find(key)
+            if i >= 0:
+                return self.array[i + 1]
+        return default
+
+    def assoc(self, key, value, h, shift):
+        if h != self.hash:
+            bit = 1 << ((self.hash >> shift) & _MASK)
+            node = _BitmapNode(bit, (_NODE, self))
+            return node.assoc(key, value, h, shift)
+
+        i = self._find(key)
+        array = self.array
+
+        if i < 0:
+            return _CollisionNode(h, array + (key, value)), True
+        if array[i + 1] is value:
+            return self, False
+
+        return _CollisionNode(
+            h, array[:i + 1] + (value, ) + array[i + 2:]), False
+
+    def dissoc(self, key, h, shift):
+        if h != self.hash:
+            return self, False
+
+        i = self._find(key)
+        if i < 0:
+            return self, False
+        if len(self.array) == 2:
+            return None, True
+
+        return _CollisionNode(h, self.array[:i] + self.array[i + 2:]), True
+
+    def items(self):
+        array = self.array
+        for i in range(0, len(array), 2):
+            yield array[i], array[i + 1]
+
+
+def _pair(shift, k1, v1, h1, k2, v2, h2):
+    """
+    Returns a node holding two different keys.
+    """
+    if h1 == h2:
+        return _CollisionNode(h1, (k1, v1, k2, v2))
+
+    b1 = (h1 >> shift) & _MASK
+    b2 = (h2 >> shift) & _MASK
+
+    if b1 == b2:
+        return _BitmapNode(1 << b1,
+                           (_NODE, _pair(shift + _BITS, k1, v1, h1, k2, v2, h2)))
+    if b1 < b2:
+        return _BitmapNode((1 << b1) | (1 << b2), (k1, v1, k2, v2))
+
+    return _BitmapNode((1 << b1) | (1 << b2), (k2, v2, k1, v1))
+
+
+def _bulk(entries, shift):
+    """
+    Returns a node holding `entries`, a list of hashes, keys and values
+    with distinct keys, built without intermediate versions.
+    """
+    if len(entries) > 1 and all(e[0] == entries[0][0] for e in entries):
+        return _CollisionNode(entries[0][0],
+                              tuple(x for _, k, v in entries for x in (k, v)))
+
+    buckets = {}
+    for entry in entries:
+        buckets.setdefault((entry[0] >> shift) & _MASK, []).append(entry)
+
+    bitmap = 0
+    array = []
+    for b in sorted(buckets):
+        bitmap |= 1 << b
+        bucket = buckets[b]
+        if len(bucket) == 1:
+            array += bucket[0][1:]
+        else:
+            array += (_NODE, _bulk(bucket, shift + _BITS))
+
+    return _BitmapNode(bitmap, tuple(array))
+
+
+_EMPTY_NODE = _BitmapNode(0, ())
+
+
+class PersistentMap(Mapping):
+    """
+    An immutable mapping with cheap updates that return new versions.
+    It can be created from any mapping or iterable of pairs, like a `dict`,
+    but nested `dict`s are kept as they are, use
+    `midware.persistent.PersistentMap.from_dict` to convert them too.
+    """
+
+    __slots__ = ('_root', '_len', '_hash')
+
+    def __init__(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        self._root = _bulk([(_hash(k), k, v) for k, v in items.items()], 0)
+        self._len = len(items)
+        self._hash = None
+
+    @classmethod
+    def _make(cls, root, length):
+        m = cls.__new__(cls)
+        m._root = root
+        m._len = length
+        m._hash = None
+        return m
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Returns a persistent map with the contents of a `dict`,
+        where nested `dict`s are converted too.
+        """
+        return cls({
+            k: cls.from_dict(v) if type(v) is dict else v
+            for k, v in d.items()
+        })
+
+    def to_dict(self):
+        """
+        Returns a `dict` with the contents of this map,
+        where nested persistent maps are converted too.
+        """
+        return {
+            k: v.to_dict() if isinstance(v, PersistentMap) else v
+            for k, v in self._root.items()
+        }
+
+    def __getitem__(self, key):
+        v = self._root.get(key, _hash(key), 0, _MISSING)
+        if v is _MISSING:
+            raise KeyError(key)
+        return v
+
+    def get(self, key, default=None):
+        return self._root.get(key, _hash(key), 0, default)
+
+    def __contains__(self, key):
+        return self._root.get(key, _hash(key), 0, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for k, _ in self._root.items():
+            yield k
+
+    def items(self):
+        return self._root.items()
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+
+        for k, v in self._root.items():
+            if other.get(k, _MISSING) != v:
+                return False
+        return True
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self._root.items()))
+        return self._hash
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self._root.items()))
+
+    def __reduce__(self):
+        return type(self), (dict(self._root.items()), )
+
+    def assoc(self, key, value):
+        """
+        Returns a new version with `key` associated with `value`.
+        """
+        root, added = self._root.assoc(key, value, _hash(key), 0)
+        if root is self._root:
+            return self
+        return self._make(root, self._len + added)
+
+    def dissoc(self, key):
+        """
+        Returns a new version without `key`.
+        """
+        root, removed = self._root.dissoc(key, _hash(key), 0)
+        if not removed:
+            return self
+        return self._make(_EMPTY_NODE if root is None else root,
+                          self._len - 1)
+
+    def update(self, *args, **kwargs):
+        """
+        Returns a new version with keys and values of
+        a mapping or an iterable of pairs associated.
+        """
+        m = self
+        for k, v in dict(*args, **kwargs).items():
+            m = m.assoc(k, v)
+        return m
+
+    def assoc_in(self, ks, v):
+        """
+        Returns a new version with a value associated in a nested structure,
+        like `midware.core.assoc_in` does. Missing levels are created as
+        persistent maps and nested `dict`s are copied, not changed.
+        """
+        return _assoc_in(self, list(ks), v)
+
+    def dissoc_in(self, ks):
+        """
+        Returns a new version without a value in a nested structure.
+        """
+        return _dissoc_in(self, list(ks))
+
+
+def _assoc_in(m, ks, v):
+    if type(m) is Lazy:
+        m = m.force()
+
+    if m is _MISSING:
+        m = PersistentMap()
+    elif not isinstance(m, PersistentMap) and type(m) is not dict:
+        raise TypeError('{!r} is not a mapping'.format(type(m).__name__))
+
+    k, *rest = ks
+    if rest:
+        v = _assoc_in(m.get(k, _MISSING), rest, v)
+
+    if isinstance(m, PersistentMap):
+        return m.assoc(k, v)
+
+    m = dict(m)
+    m[k] = v
+    return m
+
+
+def _dissoc_in(m, ks):
+    k, *rest = ks
+    if not rest:
+        if isinstance(m, PersistentMap):
+            return m.dissoc(k)
+        if type(m) is dict and k in m:
+            m = dict(m)
+            del m[k]
+        return m
+
+    if not isinstance(m, (PersistentMap, dict)) or k not in m:
+        return m
+
+    level = m[k]
+    if type(level) is Lazy:
+        level = level.force()
+
+    v = _dissoc_in(level, rest)
+    if v is level:
+        return m
+
+    return _assoc_in(m, [k], v)
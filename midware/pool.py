@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Pools of entered context managers.
+
+`midware.core.mw_from_cm` enters a context manager for every call, which is
+costly when it opens a connection or a file. `midware.pool.ResourcePool`
+keeps resources entered and hands them out one call at a time instead:
+
+    pool = midware.pool.ResourcePool(connect, maxsize=4, ttl=60)
+    mw = midware.pool.mw_from_pool('db', pool, ('db', ),
+                                   {'host': ('config', 'host')})
+
+Resources are kept apart by the arguments they were made with, so every
+`host` above gets its own resources.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from midware.core import _ctx_kwargs, _instrument, assoc_in
+
+
+class _Entry:
+    """
+    An entered context manager, the resource it returned
+    and when it was last returned to the pool.
+    """
+
+    __slots__ = ('key', 'cm', 'resource', 'released')
+
+    def __init__(self, key, cm, resource):
+        self.key = key
+        self.cm = cm
+        self.resource = resource
+        self.released = time.monotonic()
+
+
+def _key(kwargs):
+    return tuple(sorted(kwargs.items()))
+
+
+class ResourcePool:
+    """
+    Keeps up to `maxsize` resources for every set of arguments
+    of `cm_constructor`, entered and ready to be checked out.
+    The arguments are the key, so they have to be hashable.
+
+    A resource that's been idle for more than `ttl` seconds is closed
+    the next time the pool is used, and one that `validate` returns a false
+    value for is closed instead of being checked out. When all resources
+    are checked out, `checkout` waits for up to `timeout` seconds
+    for one to be returned and raises `TimeoutError` after that.
+    Errors of closing resources aren't raised, they're counted
+    in `stats` and the last one is kept in `last_close_error`.
+
+    It's safe to share a pool between threads.
+    """
+
+    def __init__(self,
+                 cm_constructor,
+                 maxsize=8,
+                 ttl=None,
+                 validate=None,
+                 timeout=None):
+        if maxsize < 1:
+            raise ValueError('maxsize must be positive')
+
+        self.cm_constructor = cm_constructor
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.validate = validate
+        self.timeout = timeout
+
+        self._cond = threading.Condition()
+        self._idle = {}
+        self._sizes = {}
+        self._closed = False
+
+        self.checkouts = 0
+        self.created = 0
+        self.discarded = 0
+        self.close_errors = 0
+        self.last_close_error = None
+        self.wait_s = 0.0
+        self.max_wait_s = 0.0
+
+    def _expired(self, now):
+        """
+        Takes idle resources that outlived `ttl` out of the pool
+        and returns them. Called with the lock held.
+        """
+        if self.ttl is None:
+            return []
+
+        expired = []
+        for idle in self._idle.values():
+            while idle and now - idle[0].released > self.ttl:
+                expired.append(idle.popleft())
+
+        return expired
+
+    def _discard(self, entries):
+        """
+        Closes resources that were taken out of the pool, one at a time,
+        so that one failing to close doesn't keep the others open
+        or raise into a checkout of another key.
+        """
+        for entry in entries:
+            error = None
+            try:
+                entry.cm.__exit__(None, None, None)
+            except Exception as e:
+                error = e
+            finally:
+                with self._cond:
+                    self._sizes[entry.key] -= 1
+                    self.discarded += 1
+                    if error is not None:
+                        self.close_errors += 1
+                        self.last_close_error = error
+                    self._cond.notify()
+
+    def _acquire(self, kwargs):
+        key = _key(kwargs)
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        waited = 0.0
+
+        while True:
+            entry = None
+            create = False
+            start = time.monotonic()
+
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise RuntimeError('the pool is closed')
+
+                    now = time.monotonic()
+                    expired = self._expired(now)
+                    if expired:
+                        break
+
+                    idle = self._idle.get(key)
+                    if idle:
+                        entry = idle.pop()
+                        break
+                    if self._sizes.get(key, 0) < self.maxsize:
+                        self._sizes[key] = self._sizes.get(key, 0) + 1
+                        create = True
+                        break
+
+                    if deadline is not None and now >= deadline:
+                        raise TimeoutError('no resource was returned in time')
+                    self._cond.wait(None if deadline is None else deadline -
+                                    now)
+
+                waited += time.monotonic() - start
+
+            if expired:
+                self._discard(expired)
+                continue
+
+            if entry is not None:
+                if self.validate is not None and not self.validate(
+                        entry.resource):
+                    self._discard([entry])
+                    continue
+            elif create:
+                try:
+                    cm = self.cm_constructor(**kwargs)
+                    entry = _Entry(key, cm, cm.__enter__())
+                except BaseException:
+                    with self._cond:
+                        self._sizes[key] -= 1
+                        self._cond.notify()
+                    raise
+
+            break
+
+        with self._cond:
+            self.checkouts += 1
+            self.created += create
+            self.wait_s += waited
+            self.max_wait_s = max(self.max_wait_s, waited)
+
+        return entry
+
+    def _release(self, entry):
+        entry.released = time.monotonic()
+
+        with self._cond:
+            if not self._closed:
+                self._idle.setdefault(entry.key, deque()).append(entry)
+                self._cond.notify()
+                return
+
+        self._discard([entry])
+
+    @contextmanager
+    def checkout(self, **kwargs):
+        """
+        Returns a context manager that checks out a resource made with
+        `kwargs` and returns it to the pool on exit.
+        """
+        entry = self._acquire(kwargs)
+        try:
+            yield entry.resource
+        finally:
+            self._release(entry)
+
+    def prune(self):
+        """
+        Closes idle resources that outlived `ttl`.
+        """
+        with self._cond:
+            expired = self._expired(time.monotonic())
+
+        self._discard(expired)
+
+    def close(self):
+        """
+        Closes idle resources. Checked out ones are closed when they're
+        returned, and nothing can be checked out any more.
+        """
+        with self._cond:
+            self._closed = True
+            idle = [entry for q in self._idle.values() for entry in q]
+            self._idle.clear()
+            self._cond.notify_all()
+
+        self._discard(idle)
+
+    def stats(self):
+        """
+        Returns counters of the pool as a `dict`. `utilisation` is the share
+        of open resources that are checked out right now, and waits are
+        in seconds.
+        """
+        with self._cond:
+            size = sum(self._sizes.values())
+            idle = sum(len(q) for q in self._idle.values())
+            return {
+                'size': size,
+                'idle': idle,
+                'in_use': size - idle,
+                'utilisation': (size - idle) / size if size else 0.0,
+                'checkouts': self.checkouts,
+                'created': self.created,
+                'discarded': self.discarded,
+                'close_errors': self.close_errors,
+                'wait_s': self.wait_s,
+                'max_wait_s': self.max_wait_s,
+            }
+
+
+def mw_from_pool(name, pool, ks=None, ctx_args={}, **kwargs):
+    """
+    Same as `midware.core.mw_from_cm`, but checks a resource out
+    of a `midware.pool.ResourcePool` instead of entering a new one.
+    """
+
+    def new_middleware(handler):
+        def new_handler(ctx):
+            ctx_kwargs = _ctx_kwargs(ctx, ctx_args)
+
+            with pool.checkout(**ctx_kwargs, **kwargs) as v:
+                if ks:
+                    assoc_in(ctx, ks, v)
+                new_ctx = handler(ctx)
+
+            return new_ctx
+
+        return _instrument(name, new_handler)
+
+    return new_middleware
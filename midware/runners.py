@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Running one chain over many contexts.
+
+`midware.runners.run_many` is `midware.core.wrap_and_call` for an iterable
+of contexts. The chain is built once and results are streamed lazily,
+so memory doesn't grow with the number of contexts:
+
+    for ctx in midware.runners.run_many(records, handler, *middleware):
+        ...
+
+`midware.runners.run_parallel` calls a `midware.core.Pipeline` with contexts
+on a pool of threads or processes:
+
+    pipeline = midware.core.Pipeline(handler, *middleware)
+    for ctx in midware.runners.run_parallel(records, pipeline, workers=8):
+        ...
+"""
+
+import collections
+import itertools
+import os
+import time
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+
+from midware.core import Pipeline
+
+_ERRORS = ('raise', 'skip', 'yield')
+_EXECUTORS = ('threads', 'processes')
+
+_worker_pipeline = None
+"""
+The pipeline of the current worker process.
+"""
+
+
+class Run:
+    """
+    An iterator over results of calling a chain with every `ctx` of `ctxs`.
+    It counts `processed` and `failed` contexts and the time `elapsed`
+    since the first one was taken.
+    """
+
+    def __init__(self, ctxs, pipeline, chunksize=None, errors='raise'):
+        if errors not in _ERRORS:
+            raise ValueError('unknown error policy: {!r}'.format(errors))
+        if chunksize is not None and chunksize < 1:
+            raise ValueError('chunksize must be positive')
+
+        self.pipeline = pipeline
+        self.chunksize = chunksize
+        self.errors = errors
+        self.processed = 0
+        self.failed = 0
+        self._started = None
+        self._finished = None
+
+        results = self._results(iter(ctxs))
+        if chunksize is not None:
+            results = self._chunks(results, chunksize)
+        self._iterator = results
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iterator)
+
+    def _results(self, ctxs):
+        pipeline = self.pipeline
+        errors = self.errors
+        self._started = time.perf_counter()
+
+        try:
+            for ctx in ctxs:
+                try:
+                    new_ctx = pipeline(ctx)
+                except Exception as e:
+                    self.failed += 1
+                    if errors == 'raise':
+                        raise
+                    if errors == 'yield':
+                        yield e
+                    continue
+
+                self.processed += 1
+                yield new_ctx
+        finally:
+            self._finished = time.perf_counter()
+
+    @staticmethod
+    def _chunks(results, chunksize):
+        while True:
+            chunk = list(itertools.islice(results, chunksize))
+            if not chunk:
+                return
+            yield chunk
+
+    @property
+    def elapsed(self):
+        """
+        Seconds since the first `ctx` was taken until the last result,
+        or until now if the run is not over.
+        """
+        if self._started is None:
+            return 0.0
+        if self._finished is None:
+            return time.perf_counter() - self._started
+        return self._finished - self._started
+
+    @property
+    def throughput(self):
+        """
+        Contexts processed or failed per second.
+        """
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0.0
+        return (self.processed + self.failed) / elapsed
+
+
+def run_many(ctxs,
+             handler,
+             *middleware,
+             chunksize=None,
+             errors='raise',
+             verbose=False,
+             instrument=None):
+    """
+    Layers `middleware` left to right around the `handler` once and
+    returns a `midware.runners.Run`, which lazily calls it with every `ctx`
+    of `ctxs` and yields the results one by one, or in lists of up to
+    `chunksize` results, if it's given.
+
+    When the chain raises an `Exception`, `errors` decides what happens:
+
+    - `'raise'` propagates it and ends the run,
+    - `'skip'` drops the `ctx` and goes on,
+    - `'yield'` yields the exception in place of the result.
+
+    `verbose` and `instrument` are the same as in `midware.core.Pipeline`.
+    """
+    pipeline = Pipeline(
+        handler, *middleware, verbose=verbose, instrument=instrument)
+
+    return Run(ctxs, pipeline, chunksize=chunksize, errors=errors)
+
+
+def _init_worker(pipeline):
+    global _worker_pipeline
+    _worker_pipeline = pipeline
+
+
+def _call_worker(ctx):
+    return _worker_pipeline(ctx)
+
+
+def run_parallel(ctxs,
+                 pipeline,
+                 executor='threads',
+                 workers=None,
+                 ordered=True,
+                 max_in_flight=None):
+    """
+    Calls a `pipeline` with every `ctx` of `ctxs` on a pool of `workers`
+    and lazily yields the results, in the order of `ctxs` if `ordered`
+    or as they are ready otherwise.
+
+    `executor` is `'threads'`, where the threads share the `pipeline`,
+    or `'processes'`, where it's pickled and its chain is built once
+    in every process. Contexts and results are pickled too then, so the
+    handler, middleware and contexts have to be picklable, for example
+    defined at the module level.
+
+    At most `max_in_flight` contexts, twice the number of workers
+    by default, are taken from `ctxs` before their results are yielded.
+    An exception raised by the `pipeline` is raised when its result would
+    be yielded and the contexts that are not started yet are dropped.
+    """
+    if executor not in _EXECUTORS:
+        raise ValueError('unknown executor: {!r}'.format(executor))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError('workers must be positive')
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    if max_in_flight < 1:
+        raise ValueError('max_in_flight must be positive')
+
+    return _run_parallel(iter(ctxs), pipeline, executor, workers, ordered,
+                         max_in_flight)
+
+
+def _run_parallel(ctxs, pipeline, executor, workers, ordered, max_in_flight):
+    if executor == 'processes':
+        pool = ProcessPoolExecutor(workers,
+                                   initializer=_init_worker,
+                                   initargs=(pipeline, ))
+        call = _call_worker
+    else:
+        pool = ThreadPoolExecutor(workers)
+        call = pipeline
+
+    pending = collections.deque() if ordered else set()
+    submit = pending.append if ordered else pending.add
+
+    try:
+        for ctx in itertools.islice(ctxs, max_in_flight):
+            submit(pool.submit(call, ctx))
+
+        while pending:
+            if ordered:
+                done = (pending.popleft(), )
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                pending -= done
+
+            for future in done:
+                result = future.result()
+                for ctx in itertools.islice(ctxs, 1):
+                    submit(pool.submit(call, ctx))
+                yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
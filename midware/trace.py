@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Spans of named layers in the Chrome trace event format.
+
+`midware.trace.Tracer` is a `midware.core.Probe`, so it's chosen as
+instrumentation when a chain is built:
+
+    tracer = midware.trace.Tracer()
+    pipeline = midware.core.Pipeline(handler, *middleware, instrument=tracer)
+    ...
+    with open('trace.json', 'w') as f:
+        tracer.dump(f)
+
+The file opens in Perfetto (https://ui.perfetto.dev) or `chrome://tracing`.
+Every thread gets a track and so does every `asyncio` task, because spans
+of concurrent tasks on one thread don't nest.
+"""
+
+import json
+import os
+import threading
+import time
+from asyncio import _get_running_loop, current_task
+from itertools import count
+
+from midware.core import Probe
+
+
+def _current_task():
+    """
+    Returns the current `asyncio` task or `None`.
+    """
+    loop = _get_running_loop()
+    if loop is None:
+        return None
+    return current_task(loop)
+
+
+def _task_name(task):
+    """
+    Returns the name of a task, or its `str` on Python 3.7 where tasks
+    have no names.
+    """
+    get_name = getattr(task, 'get_name', None)
+    if get_name is None:
+        return str(task)
+    return get_name()
+
+
+class Tracer(Probe):
+    """
+    Records a span with nanosecond timestamps for every call of a named
+    layer into a ring buffer that keeps the last `capacity` spans.
+    """
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        """
+        Drops all recorded spans.
+        """
+        self._spans = [None] * self.capacity
+        self._next = count()
+
+    def enter(self, name, ctx):
+        return time.perf_counter_ns()
+
+    def exit(self, name, token, ctx, error):
+        end = time.perf_counter_ns()
+        task = _current_task()
+        i = next(self._next)
+        self._spans[i % self.capacity] = (
+            i, name, token, end - token, threading.get_ident(),
+            None if task is None else id(task),
+            None if task is None else _task_name(task),
+            None if error is None else repr(error))
+
+    def spans(self):
+        """
+        Returns recorded spans ordered by start time as tuples of an index,
+        a layer name, start time and duration in nanoseconds, a thread id,
+        a task id and name if there was a running task, and a `repr` of
+        an exception if the layer raised one.
+        """
+        return sorted((s for s in list(self._spans) if s is not None),
+                      key=lambda s: (s[2], -s[3]))
+
+    def dropped(self):
+        """
+        Returns how many spans were overwritten in the ring buffer.
+        """
+        spans = [s for s in list(self._spans) if s is not None]
+        if not spans:
+            return 0
+        return max(s[0] for s in spans) + 1 - len(spans)
+
+    def events(self):
+        """
+        Returns recorded spans as a list of Chrome trace events.
+        """
+        pid = os.getpid()
+        events = []
+        tracks = {}
+
+        for (_, name, start, duration, thread, task, task_name,
+             error) in self.spans():
+            if task is None:
+                tid = thread
+                tracks[tid] = 'Thread {}'.format(thread)
+            else:
+                tid = task
+                tracks[tid] = '{} on thread {}'.format(task_name, thread)
+            event = {
+                'name': name,
+                'cat': 'midware',
+                'ph': 'X',
+                'ts': start / 1000,
+                'dur': duration / 1000,
+                'pid': pid,
+                'tid': tid,
+            }
+            if error is not None:
+                event['args'] = {'error': error}
+            events.append(event)
+
+        for tid, track in tracks.items():
+            events.append({
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': pid,
+                'tid': tid,
+                'args': {
+                    'name': track
+                },
+            })
+
+        return events
+
+    def dumps(self):
+        """
+        Returns recorded spans as Chrome trace event JSON.
+        """
+        return json.dumps({
+            'traceEvents': self.events(),
+            'displayTimeUnit': 'ns'
+        })
+
+    def dump(self, fp):
+        """
+        Writes recorded spans as Chrome trace event JSON to a file object.
+        """
+        fp.write(self.dumps())
@@ -17,5 +17,7 @@ setup(
     author_email='ivan.dmitrievsky+python@gmail.com',
     url='https://github.com/idmit/midware',
     install_requires=[],
+    extras_require={'numpy': ['numpy']},
+    python_requires='>=3.7',
     license=license_,
     packages=find_packages(exclude=('tests', 'docs')))
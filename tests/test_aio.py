@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+import midware.aio as aio
+import midware.core as core
+
+
+@aio.middleware('wrap_add')
+async def wrap_add(ctx):
+    await asyncio.sleep(0)
+    ctx['value'] += ctx['amount']
+
+    new_ctx = yield ctx
+
+    new_ctx['post'] = True
+
+    yield new_ctx
+
+
+@core.middleware('wrap_sub', 1)
+def wrap_sub(ctx, amount):
+    ctx['value'] -= amount
+
+    new_ctx = yield ctx
+
+    yield new_ctx
+
+
+@aio.named('wrap_named')
+def wrap_named(handler):
+    async def new_handler(ctx):
+        ctx['seen'] = True
+        return await handler(ctx)
+
+    return new_handler
+
+
+async def add_one(ctx):
+    await asyncio.sleep(0)
+    ctx['value'] += 1
+    return ctx
+
+
+def test_middleware():
+    ctx = asyncio.run(wrap_add(add_one)({'value': 1, 'amount': 2}))
+
+    assert ctx['value'] == 4
+    assert ctx['post']
+
+
+def test_wrap_and_call_async():
+    ctx = asyncio.run(
+        aio.wrap_and_call_async({
+            'value': 1,
+            'amount': 2
+        }, add_one, wrap_add, wrap_named, wrap_sub))
+
+    assert ctx == {'value': 3, 'amount': 2, 'seen': True, 'post': True}
+
+
+def test_sync_handler():
+    ctx = asyncio.run(
+        aio.AsyncPipeline(core.identity, wrap_add)({
+            'value': 1,
+            'amount': 2
+        }))
+
+    assert ctx['value'] == 3
+
+
+def test_pipeline_verbose(capsys):
+    pipeline = aio.AsyncPipeline(add_one, wrap_add, wrap_named, wrap_sub,
+                                 verbose=True)
+    asyncio.run(pipeline({'value': 1, 'amount': 2}))
+
+    out, err = capsys.readouterr()
+    assert out == ('wrap_add--->\nwrap_named--->\nwrap_sub--->\n'
+                   '<---wrap_sub\n<---wrap_named\n<---wrap_add\n')
+    assert err == ''
+
+
+def test_pipeline_deep():
+    pipeline = aio.AsyncPipeline(add_one, *(wrap_add, ) * 5000)
+
+    ctx = asyncio.run(pipeline({'value': 0, 'amount': 1}))
+
+    assert ctx['value'] == 5001
+
+
+def test_pipeline_concurrent():
+    pipeline = aio.AsyncPipeline(add_one, wrap_add, wrap_sub)
+
+    async def main():
+        return await asyncio.gather(*(pipeline({
+            'value': k,
+            'amount': 2
+        }) for k in range(1000)))
+
+    ctxs = asyncio.run(main())
+
+    assert [ctx['value'] for ctx in ctxs] == [k + 2 for k in range(1000)]
+
+
+def test_pipeline_closes_generators():
+    closed = []
+
+    async def track(ctx):
+        try:
+            new_ctx = yield ctx
+            yield new_ctx
+        except GeneratorExit:
+            closed.append('track')
+            raise
+
+    async def fail(ctx):
+        raise KeyError('fail')
+
+    pipeline = aio.AsyncPipeline(fail, aio.middleware('track')(track), wrap_sub)
+
+    with pytest.raises(KeyError):
+        asyncio.run(pipeline({'value': 0}))
+
+    assert closed == ['track']
+
+
+class Double(core.Layer):
+    name = 'double'
+
+    def before(self, ctx):
+        ctx['value'] *= 2
+        return ctx
+
+
+def test_layer():
+    pipeline = aio.AsyncPipeline(add_one, Double(), wrap_add, Double())
+
+    ctx = asyncio.run(pipeline({'value': 1, 'amount': 1}))
+
+    assert ctx == {'value': 7, 'amount': 1, 'post': True}
+    assert asyncio.run(aio.AsyncPipeline(add_one, Double())({
+        'value': 1
+    })) == {'value': 3}
+
+
+def test_verbose_is_scoped_per_task(capsys):
+    async def main():
+        await asyncio.gather(
+            aio.wrap_and_call_async({}, add_one_later, wrap_named,
+                                    verbose=True),
+            *(aio.wrap_and_call_async({'value': 1, 'amount': 2}, add_one,
+                                      wrap_add) for _ in range(10)))
+
+    async def add_one_later(ctx):
+        await asyncio.sleep(0.01)
+        return ctx
+
+    asyncio.run(main())
+
+    out, err = capsys.readouterr()
+    assert out == 'wrap_named--->\n<---wrap_named\n'
+    assert err == ''
+
+
+def test_instrumentation_probe():
+    events = []
+
+    class Probe(core.Probe):
+        def enter(self, name, ctx):
+            events.append('{}--->'.format(name))
+
+        def exit(self, name, token, ctx, error):
+            events.append('<---{}'.format(name))
+
+    pipeline = aio.AsyncPipeline(add_one, wrap_named, wrap_add, wrap_sub,
+                                 instrument=Probe())
+    asyncio.run(pipeline({'value': 1, 'amount': 2}))
+
+    assert events == [
+        'wrap_named--->', 'wrap_add--->', 'wrap_sub--->', '<---wrap_sub',
+        '<---wrap_add', '<---wrap_named'
+    ]
+
+
+class Resource:
+    def __init__(self, log, tag, fail=False, source=None, delay=0.05):
+        self.log = log
+        self.tag = tag
+        self.fail = fail
+        self.source = source
+        self.delay = delay
+
+    async def __aenter__(self):
+        self.log.append(('enter', self.tag))
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise KeyError(self.tag)
+        return self.source or self.tag
+
+    async def __aexit__(self, *exc_info):
+        self.log.append(('exit', self.tag))
+
+
+def test_mw_from_acm():
+    log = []
+    pipeline = aio.AsyncPipeline(
+        add_one, aio.mw_from_acm('a', Resource, ('a', ), log=log, tag='a'),
+        wrap_sub, aio.mw_from_acm('b', Resource, ('b', ), log=log, tag='b'))
+
+    ctx = asyncio.run(pipeline({'value': 1}))
+
+    assert ctx == {'value': 1, 'a': 'a', 'b': 'b'}
+    assert log == [('enter', 'a'), ('enter', 'b'), ('exit', 'b'),
+                   ('exit', 'a')]
+
+
+def test_mw_from_acm_concurrent():
+    log = []
+    layers = [
+        aio.mw_from_acm(tag, Resource, ('res', tag), log=log, tag=tag)
+        for tag in 'abcd'
+    ]
+    layers.append(
+        aio.mw_from_acm('e', Resource, ('res', 'e'), {'source': ('res', 'a')},
+                        log=log, tag='e'))
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        ctx = await aio.AsyncPipeline(add_one, *layers)({'value': 0})
+        return ctx, loop.time() - start
+
+    ctx, elapsed = asyncio.run(main())
+
+    assert ctx['res'] == {'a': 'a', 'b': 'b', 'c': 'c', 'd': 'd', 'e': 'a'}
+    assert elapsed < 0.15
+    assert log[-5:] == [('exit', tag) for tag in 'edcba']
+
+
+def test_mw_from_acm_concurrent_errors():
+    log = []
+    pipeline = aio.AsyncPipeline(
+        add_one, aio.mw_from_acm('a', Resource, ('a', ), log=log, tag='a'),
+        aio.mw_from_acm('b', Resource, ('b', ), log=log, tag='b', fail=True),
+        aio.mw_from_acm('c', Resource, ('c', ), log=log, tag='c'))
+
+    with pytest.raises(KeyError):
+        asyncio.run(pipeline({'value': 0}))
+
+    assert sorted(log) == [('enter', 'a'), ('enter', 'b'), ('enter', 'c'),
+                           ('exit', 'a'), ('exit', 'c')]
+    assert log[-2:] == [('exit', 'c'), ('exit', 'a')]
+
+
+def test_mw_from_acm_concurrent_cancelled():
+    log = []
+    pipeline = aio.AsyncPipeline(
+        add_one,
+        aio.mw_from_acm('a', Resource, ('a', ), log=log, tag='a', delay=0),
+        aio.mw_from_acm('b', Resource, ('b', ), log=log, tag='b', delay=10))
+
+    async def main():
+        task = asyncio.ensure_future(pipeline({'value': 0}))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+
+    assert log == [('enter', 'a'), ('enter', 'b'), ('exit', 'a')]
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import midware.aio as aio
+import midware.core as core
+from midware.cache import ResultCache, SingleFlight, _sizeof
+from midware.persistent import PersistentMap
+
+
+def counting_handler(calls):
+    def handler(ctx):
+        calls.append(ctx['sku'])
+        if ctx['sku'] < 0:
+            raise ValueError(ctx['sku'])
+        ctx['price'] = ctx['sku'] * 10
+        return ctx
+
+    return handler
+
+
+def test_result_cache():
+    calls = []
+    cache = ResultCache('prices', [('sku', )], outputs=[('price', )])
+    pipeline = core.Pipeline(counting_handler(calls), cache)
+
+    assert pipeline({'sku': 1, 'user': 'a'}) == {'sku': 1, 'user': 'a',
+                                                 'price': 10}
+    assert pipeline({'sku': 1, 'user': 'b'}) == {'sku': 1, 'user': 'b',
+                                                 'price': 10}
+    assert pipeline({'sku': 2})['price'] == 20
+    assert calls == [1, 2]
+    assert cache.info()['hits'] == 1
+    assert cache.info()['misses'] == 2
+
+    ctx = pipeline(PersistentMap({'sku': 2}))
+    assert ctx == {'sku': 2, 'price': 20}
+    assert calls == [1, 2]
+
+
+def test_result_cache_whole_ctx():
+    calls = []
+    cache = ResultCache('prices', [('sku', )])
+    pipeline = core.Pipeline(counting_handler(calls), cache)
+
+    pipeline({'sku': 1})
+    assert pipeline({'sku': 1, 'user': 'a'}) == {'sku': 1, 'user': 'a',
+                                                 'price': 10}
+    assert calls == [1]
+
+
+def test_result_cache_keeps_other_fields():
+    def handler(ctx):
+        ctx['price'] = {'amount': ctx['request']['sku'] * 10}
+        return ctx
+
+    cache = ResultCache('prices', [('request', 'sku')])
+    pipeline = core.Pipeline(handler, cache)
+
+    first = pipeline({'request': {'sku': 1, 'user': 'alice'}})
+    first['price']['amount'] = 0
+    second = pipeline({'request': {'sku': 1, 'user': 'bob'}})
+    core.assoc_in(second, ('price', 'amount'), -1)
+    third = pipeline({'request': {'sku': 1, 'user': 'carol'}})
+
+    assert second['request'] == {'sku': 1, 'user': 'bob'}
+    assert third == {
+        'request': {
+            'sku': 1,
+            'user': 'carol'
+        },
+        'price': {
+            'amount': 10
+        }
+    }
+    assert cache.info()['hits'] == 2
+
+
+def test_result_cache_unhashable():
+    cache = ResultCache('echo', [('items', )])
+    pipeline = core.Pipeline(core.identity, cache)
+
+    pipeline({'items': [1]})
+    pipeline({'items': [1]})
+
+    assert len(cache) == 0
+    assert cache.info()['misses'] == 0
+
+
+def test_result_cache_eviction():
+    calls = []
+    cache = ResultCache('prices', [('sku', )], maxsize=2, ttl=0.02)
+    pipeline = core.Pipeline(counting_handler(calls), cache)
+
+    for sku in (1, 2, 1, 3, 1, 2):
+        pipeline({'sku': sku})
+
+    assert calls == [1, 2, 3, 2]
+    assert cache.evictions == 2
+
+    time.sleep(0.03)
+    pipeline({'sku': 1})
+    assert calls == [1, 2, 3, 2, 1]
+
+
+def test_result_cache_maxbytes():
+    cache = ResultCache('echo', [('k', )], maxbytes=2 * _sizeof([('v', 0)]))
+    pipeline = core.Pipeline(lambda ctx: core.assoc_in(ctx, ('v', ), ctx['k']),
+                             cache)
+
+    for k in range(5):
+        pipeline({'k': k})
+
+    assert 0 < cache.nbytes <= cache.maxbytes
+    assert cache.evictions == 5 - len(cache)
+
+    size = len(cache)
+    pipeline({'k': 'x' * 10000})
+    assert len(cache) == size
+
+
+def test_result_cache_errors():
+    calls = []
+    cache = ResultCache('prices', [('sku', )], error_ttl=60)
+    pipeline = core.Pipeline(counting_handler(calls), cache)
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            pipeline({'sku': -1})
+
+    assert calls == [-1]
+
+
+def test_result_cache_async():
+    calls = []
+
+    async def handler(ctx):
+        calls.append(ctx['sku'])
+        ctx['price'] = ctx['sku'] * 10
+        return ctx
+
+    cache = ResultCache('prices', [('sku', )], outputs=[('price', )])
+    pipeline = aio.AsyncPipeline(handler, cache)
+
+    async def main():
+        return [await pipeline({'sku': 1}) for _ in range(3)]
+
+    assert [ctx['price'] for ctx in asyncio.run(main())] == [10, 10, 10]
+    assert calls == [1]
+
+
+def test_single_flight_threads():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def handler(ctx):
+        calls.append(ctx['sku'])
+        started.set()
+        release.wait()
+        ctx['price'] = ctx['sku'] * 10
+        return ctx
+
+    flight = SingleFlight('prices', [('sku', )], outputs=[('price', )])
+    pipeline = core.Pipeline(handler, flight)
+    results = []
+
+    def call(user):
+        results.append(pipeline({'sku': 1, 'user': user}))
+
+    leader = threading.Thread(target=call, args=('a', ))
+    leader.start()
+    started.wait()
+
+    followers = [
+        threading.Thread(target=call, args=(user, )) for user in 'bcd'
+    ]
+    for t in followers:
+        t.start()
+    while flight.info()['coalesced'] < 3:
+        time.sleep(0.001)
+    release.set()
+    for t in [leader] + followers:
+        t.join()
+
+    assert calls == [1]
+    assert sorted(ctx['user'] for ctx in results) == ['a', 'b', 'c', 'd']
+    assert all(ctx['price'] == 10 for ctx in results)
+    assert flight.info() == {'calls': 1, 'coalesced': 3, 'in_flight': 0}
+
+
+def test_single_flight_async():
+    calls = []
+
+    async def handler(ctx):
+        calls.append(ctx['sku'])
+        await asyncio.sleep(0.01)
+        if ctx['sku'] < 0:
+            raise ValueError(ctx['sku'])
+        ctx['price'] = ctx['sku'] * 10
+        return ctx
+
+    pipeline = aio.AsyncPipeline(handler,
+                                 SingleFlight('prices', [('sku', )]))
+
+    async def main():
+        ok = await asyncio.gather(*(pipeline({'sku': 1}) for _ in range(5)))
+        failed = await asyncio.gather(
+            *(pipeline({'sku': -1}) for _ in range(3)), return_exceptions=True)
+        return ok, failed
+
+    ok, failed = asyncio.run(main())
+
+    assert calls == [1, -1]
+    assert [ctx['price'] for ctx in ok] == [10] * 5
+    assert all(isinstance(e, ValueError) for e in failed)
+
+
+def test_single_flight_keeps_other_fields():
+    async def handler(ctx):
+        await asyncio.sleep(0.01)
+        ctx['price'] = {'amount': ctx['request']['sku'] * 10}
+        return ctx
+
+    flight = SingleFlight('prices', [('request', 'sku')])
+    pipeline = aio.AsyncPipeline(handler, flight)
+
+    async def main():
+        return await asyncio.gather(*(pipeline({
+            'request': {
+                'sku': 1,
+                'user': user
+            }
+        }) for user in ('alice', 'bob', 'carol')))
+
+    ctxs = asyncio.run(main())
+
+    assert [ctx['request']['user'] for ctx in ctxs] == ['alice', 'bob', 'carol']
+    assert all(ctx['price'] == {'amount': 10} for ctx in ctxs)
+    assert ctxs[0]['price'] is not ctxs[1]['price']
+    assert flight.info()['coalesced'] == 2
+
+
+def test_single_flight_cancelled_leader():
+    calls = []
+
+    async def handler(ctx):
+        calls.append(ctx['sku'])
+        await asyncio.sleep(0.01)
+        ctx['price'] = 10
+        return ctx
+
+    pipeline = aio.AsyncPipeline(handler,
+                                 SingleFlight('prices', [('sku', )]))
+
+    async def main():
+        leader = asyncio.ensure_future(pipeline({'sku': 1}))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(pipeline({'sku': 1}))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(main())['price'] == 10
+    assert calls == [1, 1]
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+from array import array
+
+import pytest
+
+import midware.columns as columns
+import midware.core as core
+from midware.persistent import PersistentMap
+
+
+def results():
+    return [
+        {'timing': {'latency': 1.5}, 'size': 10},
+        {'timing': {}, 'size': 20},
+        PersistentMap.from_dict({'timing': {'latency': 2.5}}),
+    ]
+
+
+@pytest.fixture
+def without_numpy(monkeypatch):
+    monkeypatch.setattr(columns, 'numpy', None)
+
+
+def test_get_in_many_arrays(without_numpy):
+    latency, size = columns.get_in_many(
+        iter(results()), [('timing', 'latency'), core.path('size')],
+        dtype=['float64', 'int64'],
+        default=-1)
+
+    assert latency == array('d', [1.5, -1, 2.5])
+    assert size == array('q', [10, 20, -1])
+
+
+def test_get_in_many_one_path(without_numpy):
+    latency, = columns.get_in_many(results(), [('timing', 'latency')],
+                                   dtype='f')
+
+    assert latency == array('f', [1.5, 0, 2.5])
+
+
+def test_get_in_many_errors(without_numpy):
+    with pytest.raises(ValueError):
+        columns.get_in_many(results(), [('size', )], dtype='complex128')
+
+    with pytest.raises(ValueError):
+        columns.get_in_many(results(), [('size', )], dtype=['int8', 'int8'])
+
+    assert columns.get_in_many(results(), []) == ()
+
+
+def test_get_in_many_numpy():
+    numpy = pytest.importorskip('numpy')
+
+    latency, size = columns.get_in_many(
+        results(), [('timing', 'latency'), ('size', )],
+        dtype=['float32', 'int64'],
+        default=0)
+
+    assert latency.dtype == numpy.float32
+    assert latency.tolist() == [1.5, 0, 2.5]
+    assert size.tolist() == [10, 20, 0]
+
+
+def test_context_batch():
+    ctxs = [{'a': {'b': 1}, 'c': 'x'}, {'a': {'b': 2}}, {'d': 3}]
+
+    batch = columns.ContextBatch.from_contexts(ctxs)
+
+    assert len(batch) == 3
+    assert sorted(batch.paths()) == [('a', 'b'), ('c', ), ('d', )]
+    assert batch['a', 'b'] == [1, 2, None]
+    assert batch[core.path('c')] == ['x', None, None]
+    assert batch['d'] == [None, None, 3]
+    assert batch.to_contexts() == ctxs
+
+    batch['d'] = array('q', [4, 5, 6])
+    assert batch.to_contexts()[0]['d'] == 4
+    with pytest.raises(ValueError):
+        batch['d'] = [1]
+
+    del batch['c']
+    assert 'c' not in batch and ('a', 'b') in batch
+
+
+class Double(columns.BatchLayer):
+    name = 'double'
+
+    def before(self, ctx):
+        ctx['value'] *= 2
+        return ctx
+
+    def before_batch(self, batch):
+        batch['value'] = [v * 2 for v in batch['value']]
+        return batch
+
+    def after_batch(self, batch):
+        batch['doubled'] = [True] * len(batch)
+        return batch
+
+
+@core.middleware('wrap_add')
+def wrap_add(ctx):
+    ctx['value'] += 1
+    new_ctx = yield ctx
+    new_ctx['added'] = True
+    yield new_ctx
+
+
+class Negate(core.Layer):
+    def after(self, new_ctx):
+        new_ctx['value'] = -new_ctx['value']
+        return new_ctx
+
+
+def test_run_batch():
+    batch = columns.ContextBatch.from_contexts({'value': v} for v in range(3))
+
+    result = columns.run_batch(batch, core.identity, Double(), wrap_add,
+                               Negate(), Double())
+
+    assert result.to_contexts() == [{
+        'value': -(v * 2 + 1) * 2,
+        'added': True,
+        'doubled': True
+    } for v in range(3)]
+    assert core.Pipeline(core.identity, Double())({'value': 1}) == {'value': 2}
+
+
+def test_run_batch_batched_handler():
+    def handler(batch):
+        batch['total'] = [sum(batch['value'])] * len(batch)
+        return batch
+
+    batch = columns.ContextBatch({'value': [1, 2]})
+
+    result = columns.run_batch(batch, handler, Double(), batched=True)
+
+    assert result['total'] == [6, 6]
+
+
+def test_run_batch_errors():
+    closed = []
+
+    @core.middleware('track')
+    def track(ctx):
+        try:
+            new_ctx = yield ctx
+            yield new_ctx
+        except GeneratorExit:
+            closed.append(ctx['value'])
+            raise
+
+    def fail(ctx):
+        raise KeyError('fail')
+
+    batch = columns.ContextBatch({'value': [1, 2]})
+
+    with pytest.raises(KeyError):
+        columns.run_batch(batch, fail, track)
+    assert closed == [1, 2]
+
+    with pytest.raises(TypeError):
+        columns.run_batch(batch, core.identity, core.identity)
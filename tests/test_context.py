@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+import sys
+
+import pytest
+
+import midware
+import midware.core as core
+
+
+class Request(midware.Context):
+    __slots__ = ('user', 'body')
+
+
+class AdminRequest(Request):
+    __slots__ = 'role'
+
+
+def test_fields_and_overflow():
+    ctx = Request(user='alice', extra=1)
+
+    assert ctx['user'] == 'alice'
+    assert ctx.user == 'alice'
+    assert ctx['extra'] == 1
+    assert 'body' not in ctx
+    assert ctx.get('body', 'default') == 'default'
+    assert dict(ctx) == {'user': 'alice', 'extra': 1}
+    assert len(ctx) == 2
+
+    with pytest.raises(KeyError):
+        ctx['body']
+
+    del ctx['user']
+    del ctx['extra']
+    assert ctx == {}
+
+    with pytest.raises(KeyError):
+        del ctx['user']
+
+
+def test_inherited_fields():
+    ctx = AdminRequest(user='root', role='admin')
+
+    assert list(ctx) == ['user', 'role']
+    assert ctx._extra is None
+
+
+def test_field_clash():
+    with pytest.raises(TypeError):
+
+        class Broken(midware.Context):
+            __slots__ = ('items', )
+
+
+def test_smaller_than_dict():
+    d = {'user': 'alice', 'body': b''}
+    ctx = Request(d)
+
+    assert ctx == d
+    assert sys.getsizeof(ctx) < sys.getsizeof(d)
+
+
+def test_get_in_assoc_in():
+    ctx = Request(user={'name': 'alice'})
+
+    assert core.get_in(ctx, ('user', 'name')) == 'alice'
+    assert core.get_in({'ctx': ctx}, ('ctx', 'user', 'name')) == 'alice'
+    assert core.get_in(ctx, ('body', 'size'), 0) == 0
+
+    core.assoc_in(ctx, ('body', 'size'), 1)
+    core.assoc_in(ctx, ('meta', 'retries'), 3)
+
+    assert ctx.body == {'size': 1}
+    assert ctx['meta'] == {'retries': 3}
+
+
+def test_path():
+    ctx = Request(user={'name': 'alice'})
+    name = core.path('user', 'name')
+
+    assert name.get(ctx) == 'alice'
+    assert name.set(ctx, 'bob') is ctx
+    assert ctx.user == {'name': 'bob'}
+    assert core.path('user').delete(ctx) == {}
+
+
+def test_copy_and_pickle():
+    ctx = Request(user='alice', extra=1)
+
+    assert ctx.copy() == ctx
+    assert type(ctx.copy()) is Request
+    assert pickle.loads(pickle.dumps(ctx)) == ctx
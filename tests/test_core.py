@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import copy
+import threading
+import time
+import weakref
+
 import pytest
 
 import midware.core as core
+from midware.persistent import PersistentMap
 
 
 @pytest.fixture
@@ -40,6 +46,78 @@ def test_assoc_in():
     assert d['b']['c'] == 1
 
 
+def test_assoc_lazy():
+    calls = []
+
+    def connect():
+        calls.append(1)
+        return {'host': 'db'}
+
+    ctx = core.assoc_lazy({'user': 'alice'}, ('resources', 'db'), connect)
+    ctx = core.assoc_lazy(ctx, ('resources', 'cache'), dict)
+
+    assert calls == []
+    assert core.unforced(ctx) == [('resources', 'db'), ('resources', 'cache')]
+
+    assert core.get_in(ctx, ('resources', 'db', 'host')) == 'db'
+    assert core.path('resources', 'db').get(ctx) == {'host': 'db'}
+    assert core.get_in(ctx, ('resources', 'db')) == {'host': 'db'}
+    assert calls == [1]
+    assert core.unforced(ctx) == [('resources', 'cache')]
+
+
+def test_lazy_writes():
+    ctx = core.assoc_lazy({}, ('a', 'n'), lambda: 1)
+    assert core.path('a', 'n').update(ctx, lambda v: v + 1) == {'a': {'n': 2}}
+
+    ctx = core.assoc_lazy({}, ('a', ), lambda: {'n': 1, 'm': 2})
+    core.path('a', 'n').set(ctx, 3)
+    core.assoc_in(ctx, ('a', 'k', 'l'), 4)
+    core.path('a', 'm').delete(ctx)
+    assert core.get_in(ctx, ('a', )) == {'n': 3, 'k': {'l': 4}}
+
+    ctx = core.assoc_lazy(PersistentMap(), ('a', ), lambda: {'n': 1, 'm': 2})
+    new_ctx = core.path('a', 'n').set(ctx, 3)
+    new_ctx = core.assoc_in(new_ctx, ('a', 'k', 'l'), 4)
+    new_ctx = core.path('a', 'm').delete(new_ctx)
+    assert core.get_in(new_ctx, ('a', )) == {'n': 3, 'k': {'l': 4}}
+    assert core.get_in(ctx, ('a', )) == {'n': 1, 'm': 2}
+
+
+def test_lazy_forced_once():
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.01)
+        return len(calls)
+
+    lazy = core.Lazy(slow)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(lazy.force()))
+        for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == [1] * 8
+    assert lazy.forced
+
+
+def test_lazy_raises():
+    def fail():
+        raise KeyError('fail')
+
+    ctx = core.assoc_lazy({}, ('x', ), fail)
+
+    with pytest.raises(KeyError):
+        core.get_in(ctx, ('x', ))
+    assert core.unforced(ctx) == [('x', )]
+
+
 def test_identity():
     assert core.identity(1) == 1
     assert core.identity('a') == 'a'
@@ -64,9 +142,8 @@ def test_compose_order():
 
 @pytest.fixture
 def verbose(scope='function'):
-    core._VERBOSE_MODE = True
-    yield
-    core._VERBOSE_MODE = False
+    with core.instrumented('names'):
+        yield
 
 
 def test_print_inwards(verbose, capsys):
@@ -135,6 +212,66 @@ def test_mw_from_cm_exit(tmpdir, verbose, capsys):
     assert err == ''
 
 
+class Tracked:
+    def __init__(self, log, tag, value=None, fail=False):
+        self.log = log
+        self.tag = tag
+        self.value = value
+        self.fail = fail
+
+    def __enter__(self):
+        if self.fail:
+            raise KeyError(self.tag)
+        self.log.append(('enter', self.tag))
+        return self.value or self.tag
+
+    def __exit__(self, exc_type, exc, tb):
+        self.log.append(('exit', self.tag, exc_type))
+
+
+def test_mw_from_cms(verbose, capsys):
+    log = []
+    mw = core.mw_from_cms(
+        'resources', core.resource(Tracked, ('a', ), log=log, tag='a'),
+        core.resource(Tracked, None, log=log, tag='b'),
+        core.resource(Tracked, ('c', ), {'value': ('a', )}, log=log, tag='c'))
+
+    ctx = mw(core.identity)({})
+
+    assert ctx == {'a': 'a', 'c': 'a'}
+    assert log == [('enter', 'a'), ('enter', 'b'), ('enter', 'c'),
+                   ('exit', 'c', None), ('exit', 'b', None),
+                   ('exit', 'a', None)]
+
+    out, _ = capsys.readouterr()
+    assert out == 'resources--->\n<---resources\n'
+
+
+def test_mw_from_cms_errors():
+    log = []
+
+    def fail(ctx):
+        raise ValueError('fail')
+
+    mw = core.mw_from_cms('resources',
+                          core.resource(Tracked, log=log, tag='a'),
+                          core.resource(Tracked, log=log, tag='b'))
+
+    with pytest.raises(ValueError):
+        mw(fail)({})
+    assert log == [('enter', 'a'), ('enter', 'b'), ('exit', 'b', ValueError),
+                   ('exit', 'a', ValueError)]
+
+    log.clear()
+    mw = core.mw_from_cms('resources',
+                          core.resource(Tracked, log=log, tag='a'),
+                          core.resource(Tracked, log=log, tag='b', fail=True))
+
+    with pytest.raises(KeyError):
+        mw(core.identity)({})
+    assert log == [('enter', 'a'), ('exit', 'a', KeyError)]
+
+
 @core.middleware('wrap_add')
 def wrap_add(ctx):
     amount = ctx['amount']
@@ -228,3 +365,530 @@ def test_named_verbose(verbose, capsys):
     out, err = capsys.readouterr()
     assert out == 'wrap_named--->\n<---wrap_named\n'
     assert err == ''
+
+
+def test_wrap_and_call():
+    ctx = core.wrap_and_call({'value': 1, 'amount': 2}, core.identity,
+                             wrap_add, wrap_sub)
+
+    assert ctx['value'] == 2
+    assert ctx['post']
+
+
+def test_wrap_and_call_order():
+    ctx = core.wrap_and_call({'value': 1, 'amount': 2}, core.identity,
+                             wrap_add, wrap_replace)
+    assert ctx == {'replacement': True, 'post': True}
+
+    ctx = core.wrap_and_call({'value': 1, 'amount': 2}, core.identity,
+                             wrap_replace, wrap_add)
+    assert ctx == {'replacement': True}
+
+
+def test_pipeline():
+    calls = []
+
+    def handler(ctx):
+        calls.append(ctx['value'])
+        return ctx
+
+    pipeline = core.Pipeline(handler, wrap_add, wrap_sub)
+
+    assert pipeline({'value': 1, 'amount': 2})['value'] == 2
+    assert pipeline({'value': 5, 'amount': 0})['value'] == 4
+    assert calls == [2, 4]
+
+
+def test_pipeline_no_middleware():
+    assert core.Pipeline(core.identity)({'value': 1}) == {'value': 1}
+
+
+def test_pipeline_verbose(capsys):
+    core.Pipeline(core.identity, wrap_add, wrap_named, verbose=True)({
+        'value': 1,
+        'amount': 2
+    })
+    core.Pipeline(core.identity, wrap_add)({'value': 1, 'amount': 2})
+
+    out, err = capsys.readouterr()
+    assert out == 'wrap_add--->\nwrap_named--->\n<---wrap_named\n<---wrap_add\n'
+    assert err == ''
+
+
+@pytest.fixture
+def chain_cache():
+    cache = core.ChainCache(maxsize=2)
+    default, core.chain_cache = core.chain_cache, cache
+    yield cache
+    core.chain_cache = default
+
+
+def test_chain_cache_hits(chain_cache):
+    def handler(ctx):
+        return ctx
+
+    for _ in range(3):
+        ctx = core.wrap_and_call({'value': 1, 'amount': 2}, handler, wrap_add)
+        assert ctx['value'] == 3
+
+    assert chain_cache.info() == {
+        'hits': 2,
+        'misses': 1,
+        'evictions': 0,
+        'size': 1,
+        'maxsize': 2
+    }
+
+
+def test_chain_cache_eviction(chain_cache):
+    def a(ctx):
+        return ctx
+
+    def b(ctx):
+        return ctx
+
+    def c(ctx):
+        return ctx
+
+    for handler in (a, b, a, c, a, b):
+        core.wrap_and_call({}, handler)
+
+    assert chain_cache.hits == 2
+    assert chain_cache.misses == 4
+    assert chain_cache.evictions == 2
+
+
+def test_chain_cache_fifo():
+    cache = core.ChainCache(maxsize=2, eviction='fifo')
+
+    for handler in (add_two, add_three, add_two, core.identity, add_two):
+        cache.get(handler, ())
+
+    assert cache.hits == 1
+    assert cache.misses == 4
+
+
+def test_chain_cache_releases_handler(chain_cache):
+    def handler(ctx):
+        return ctx
+
+    core.wrap_and_call({}, handler, wrap_named)
+    assert len(chain_cache) == 1
+
+    ref = weakref.ref(handler)
+    del handler
+    assert ref() is None
+    assert len(chain_cache) == 0
+
+
+def test_chain_cache_releases_layers(chain_cache):
+    scale, mark = Scale(3), Mark()
+    for n in (1, 2):
+        ctx = core.wrap_and_call({'value': 1}, core.identity,
+                                 *(scale, mark) * n)
+        assert ctx['marks'] == ['Mark'] * n
+    assert len(chain_cache) == 2
+
+    refs = [weakref.ref(scale), weakref.ref(mark)]
+    del scale, mark
+    assert [ref() for ref in refs] == [None, None]
+    assert len(chain_cache) == 0
+
+
+def test_chain_cache_skips_instances(chain_cache):
+    class Wrap:
+        def __call__(self, handler):
+            return handler
+
+    wrap = Wrap()
+    assert core.wrap_and_call({}, core.identity, wrap, wrap_named) == {}
+    assert len(chain_cache) == 0
+
+
+class Handler:
+    def handle(self, ctx):
+        ctx['handled'] = True
+        return ctx
+
+
+def test_chain_cache_bound_methods(chain_cache):
+    handler = Handler()
+
+    for _ in range(3):
+        ctx = core.wrap_and_call({}, handler.handle, wrap_named)
+        assert ctx == {'handled': True}
+    assert chain_cache.hits == 2
+    assert chain_cache.misses == 1
+
+    ref = weakref.ref(handler)
+    del handler
+    assert ref() is None
+    assert len(chain_cache) == 0
+
+
+class Unreferenceable:
+    __slots__ = ()
+
+    def __call__(self, ctx):
+        ctx['called'] = True
+        return ctx
+
+
+def test_chain_cache_unreferenceable(chain_cache):
+    assert core.wrap_and_call({}, Unreferenceable()) == {'called': True}
+    assert len(chain_cache) == 0
+
+
+def test_chain_cache_disabled():
+    cache = core.ChainCache(maxsize=0)
+    assert cache.get(add_two, ())(1) == 3
+    assert len(cache) == 0
+
+
+def test_pipeline_deep():
+    pipeline = core.Pipeline(core.identity, *(wrap_add, ) * 10000)
+
+    ctx = pipeline({'value': 0, 'amount': 1})
+
+    assert ctx['value'] == 10000
+    assert ctx['post']
+
+
+def test_pipeline_mixed_verbose(verbose, capsys):
+    ctx = core.Pipeline(core.identity, wrap_add, wrap_named, wrap_sub,
+                        wrap_replace, verbose=True)({'value': 1, 'amount': 2})
+
+    assert ctx == {'replacement': True, 'post': True}
+
+    out, err = capsys.readouterr()
+    assert out == ('wrap_add--->\nwrap_named--->\nwrap_sub--->\n'
+                   'wrap_replace--->\n<---wrap_replace\n<---wrap_sub\n'
+                   '<---wrap_named\n<---wrap_add\n')
+    assert err == ''
+
+
+@pytest.mark.parametrize('depth', [2, core._FLAT_MIN + 1])
+def test_pipeline_closes_generators(depth):
+    closed = []
+
+    def track(ctx, tag):
+        try:
+            new_ctx = yield ctx
+            yield new_ctx
+        except GeneratorExit:
+            closed.append(tag)
+            raise
+
+    def fail(ctx):
+        raise KeyError('fail')
+
+    inner = core.middleware('inner', 'inner')(track)
+    pipeline = core.Pipeline(fail, core.middleware('outer', 'outer')(track),
+                             *(inner, ) * (depth - 1))
+
+    with pytest.raises(KeyError):
+        pipeline({})
+
+    assert closed == ['inner'] * (depth - 1) + ['outer']
+
+
+class Scale(core.Layer):
+    __slots__ = ('factor', )
+
+    name = 'scale'
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    def before(self, ctx):
+        ctx['value'] *= self.factor
+        return ctx
+
+    def after(self, new_ctx):
+        new_ctx['scaled'] = True
+        return new_ctx
+
+
+class Mark(core.Layer):
+    def after(self, new_ctx):
+        new_ctx.setdefault('marks', []).append(self.name)
+        return new_ctx
+
+
+def test_layer():
+    ctx = core.wrap_and_call({'value': 1}, core.identity, Scale(3), Mark())
+
+    assert ctx == {'value': 3, 'scaled': True, 'marks': ['Mark']}
+    assert Scale(3)(core.identity)({'value': 2}) == {'value': 6, 'scaled': True}
+
+
+def test_layer_mixed(capsys):
+    pipeline = core.Pipeline(core.identity, Scale(2), wrap_add, wrap_named,
+                             Mark(), wrap_sub, Scale(5), verbose=True)
+
+    ctx = pipeline({'value': 1, 'amount': 1})
+
+    assert ctx['value'] == (1 * 2 + 1 - 1) * 5
+    assert ctx['marks'] == ['Mark']
+
+    out, _ = capsys.readouterr()
+    assert out == ('scale--->\nwrap_add--->\nwrap_named--->\nMark--->\n'
+                   'wrap_sub--->\nscale--->\n<---scale\n<---wrap_sub\n'
+                   '<---Mark\n<---wrap_named\n<---wrap_add\n<---scale\n')
+
+
+def test_layer_errors_close_generators():
+    closed = []
+
+    @core.middleware('track')
+    def track(ctx):
+        try:
+            new_ctx = yield ctx
+            yield new_ctx
+        except GeneratorExit:
+            closed.append('track')
+            raise
+
+    def fail(ctx):
+        raise KeyError('fail')
+
+    pipeline = core.Pipeline(fail, track, Mark())
+    with pytest.raises(KeyError):
+        pipeline({})
+
+    assert closed == ['track']
+
+    with core.instrumented('timing'):
+        pipeline = core.Pipeline(fail, track, Mark())
+    with pytest.raises(KeyError):
+        pipeline({})
+
+    assert closed == ['track', 'track']
+
+
+def test_compile_chain():
+    layers = (Scale(2), wrap_add, wrap_unnamed, wrap_sub, Mark(), wrap_replace)
+    ctx = {'value': 1, 'amount': 2}
+
+    compiled = core.compile_chain(core.identity, *layers)
+
+    assert compiled(dict(ctx)) == core.Pipeline(core.identity,
+                                                *layers)(dict(ctx))
+    assert core.compile_chain(core.identity)(ctx) is ctx
+
+
+def test_compile_chain_deep():
+    compiled = core.compile_chain(core.identity, *(wrap_add, Mark()) * 5000)
+
+    ctx = compiled({'value': 0, 'amount': 1})
+
+    assert ctx['value'] == 5000
+    assert len(ctx['marks']) == 5000
+
+
+def test_compile_chain_closes_generators():
+    closed = []
+
+    def track(ctx, tag):
+        try:
+            new_ctx = yield ctx
+            yield new_ctx
+        except GeneratorExit:
+            closed.append(tag)
+            raise
+
+    def fail(ctx):
+        raise KeyError('fail')
+
+    compiled = core.compile_chain(fail,
+                                  core.middleware('outer', 'outer')(track),
+                                  Mark(),
+                                  core.middleware('inner', tag='inner')(track))
+
+    with pytest.raises(KeyError):
+        compiled({})
+
+    assert closed == ['inner', 'outer']
+
+
+def test_compile_chain_verbose(capsys):
+    core.compile_chain(core.identity, wrap_add, Mark(),
+                       verbose=True)({'value': 1, 'amount': 1})
+
+    out, _ = capsys.readouterr()
+    assert out == 'wrap_add--->\nMark--->\n<---Mark\n<---wrap_add\n'
+
+
+def test_verbose_is_scoped_per_call(capsys):
+    def handler(ctx):
+        return core.wrap_and_call(ctx, core.identity, wrap_named)
+
+    core.wrap_and_call({'value': 1, 'amount': 2}, handler, wrap_add,
+                       verbose=True)
+    core.wrap_and_call({'value': 1, 'amount': 2}, core.identity, wrap_add)
+
+    out, err = capsys.readouterr()
+    assert out == 'wrap_add--->\n<---wrap_add\n'
+    assert err == ''
+
+
+def test_verbose_is_scoped_per_thread(capsys):
+    entered = threading.Event()
+    proceed = threading.Event()
+
+    def handler(ctx):
+        entered.set()
+        proceed.wait()
+        return ctx
+
+    thread = threading.Thread(
+        target=core.wrap_and_call,
+        args=({}, handler, wrap_named),
+        kwargs={'verbose': True})
+    thread.start()
+    entered.wait()
+
+    core.wrap_and_call({'value': 1, 'amount': 2}, core.identity, wrap_add)
+
+    proceed.set()
+    thread.join()
+
+    out, err = capsys.readouterr()
+    assert out == 'wrap_named--->\n<---wrap_named\n'
+    assert err == ''
+
+
+def test_instrumentation_off():
+    handler = wrap_named(core.identity)
+    assert handler.__qualname__ == 'wrap_named.<locals>.new_handle'
+
+    handler = wrap_add(core.identity)
+    assert handler.__qualname__.endswith('.new_middleware.<locals>.new_handler')
+
+
+def test_instrumentation_unknown_mode():
+    with pytest.raises(ValueError):
+        core.Pipeline(core.identity, instrument='loud')
+
+
+def test_instrumentation_timing(capsys):
+    core.wrap_and_call({'value': 1, 'amount': 2}, core.identity, wrap_add,
+                       wrap_named, instrument='timing')
+
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    assert lines[:2] == ['wrap_add--->', 'wrap_named--->']
+    assert lines[2].startswith('<---wrap_named ') and lines[2].endswith('us')
+    assert lines[3].startswith('<---wrap_add ') and lines[3].endswith('us')
+
+
+def test_instrumentation_trace(capsys):
+    def fail(ctx):
+        raise KeyError('fail')
+
+    with pytest.raises(KeyError):
+        core.wrap_and_call({'value': 1, 'amount': 2}, fail, wrap_add,
+                           instrument='trace')
+
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    assert lines[0] == "wrap_add---> {'value': 1, 'amount': 2}"
+    assert lines[1].startswith('<---wrap_add ')
+    assert lines[1].endswith("us KeyError('fail')")
+
+
+class RecordingProbe(core.Probe):
+    def __init__(self):
+        self.events = []
+
+    def enter(self, name, ctx):
+        self.events.append(('enter', name))
+        return name
+
+    def exit(self, name, token, ctx, error):
+        assert token == name
+        self.events.append(('exit', name, type(error).__name__))
+
+
+def test_instrumentation_probe():
+    def fail(ctx):
+        raise KeyError('fail')
+
+    probe = RecordingProbe()
+    pipeline = core.Pipeline(fail, wrap_add, wrap_named, wrap_sub,
+                             instrument=probe)
+
+    with pytest.raises(KeyError):
+        pipeline({'value': 1, 'amount': 2})
+
+    assert probe.events == [
+        ('enter', 'wrap_add'),
+        ('enter', 'wrap_named'),
+        ('enter', 'wrap_sub'),
+        ('exit', 'wrap_sub', 'KeyError'),
+        ('exit', 'wrap_named', 'KeyError'),
+        ('exit', 'wrap_add', 'KeyError'),
+    ]
+
+
+def test_instrumented():
+    probe = RecordingProbe()
+
+    with core.instrumented(probe):
+        handler = wrap_named(core.identity)
+
+    handler({})
+    wrap_named(core.identity)({})
+
+    assert probe.events == [('enter', 'wrap_named'),
+                            ('exit', 'wrap_named', 'NoneType')]
+
+
+@pytest.mark.parametrize('ks', [('a'), ('a', 'b'), ('a', 'd'), ('c', 'd'),
+                                ('d'), ('a', 'b', 'c'), ('x', 'y', 'z')])
+def test_path_get(nested_dict, ks):
+    p = core.path(*ks)
+
+    assert p.get(nested_dict) == core.get_in(nested_dict, ks)
+    assert p.get(nested_dict, 'default') == core.get_in(
+        nested_dict, ks, 'default')
+    assert core.get_in(nested_dict, p) == core.get_in(nested_dict, ks)
+
+
+@pytest.mark.parametrize('ks', [('a'), ('b', 'c'), ('x', 'y', 'z')])
+def test_path_set(nested_dict, ks):
+    expected = core.assoc_in(copy.deepcopy(nested_dict), ks, 2)
+
+    assert core.path(*ks).set(nested_dict, 2) == expected
+
+
+def test_path_set_type_error():
+    with pytest.raises(TypeError):
+        core.path('a', 'b').set({'a': 0}, 0)
+
+
+def test_path_update(nested_dict):
+    p = core.path('a', 'b')
+
+    assert p.update(nested_dict, add_two)['a']['b'] == 2
+    assert core.path('x', 'y').update({}, lambda v, n: [v] * n, 2) == {
+        'x': {
+            'y': [None, None]
+        }
+    }
+
+
+def test_path_delete(nested_dict):
+    assert core.path('a', 'b').delete(nested_dict) == {'a': {}, 'c': 1}
+    assert core.path('c', 'd').delete(nested_dict) == {'a': {}, 'c': 1}
+    assert core.path('x', 'y').delete(nested_dict) == {'a': {}, 'c': 1}
+
+
+def test_path():
+    assert core.path('a', 'b') == core.Path(['a', 'b'])
+    assert len({core.path('a', 'b'), core.path('a', 'b')}) == 1
+    assert list(core.path('a', 'b')) == ['a', 'b']
+    assert repr(core.path('a', 'b')) == "path('a', 'b')"
+
+    with pytest.raises(ValueError):
+        core.path()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import midware.aio as aio
+import midware.core as core
+from midware.limit import ConcurrencyLimit, Overloaded
+
+
+def test_limit_rejects():
+    limit = ConcurrencyLimit('admission', initial_limit=1)
+    inner = []
+
+    def handler(ctx):
+        if not inner:
+            inner.append(1)
+            with pytest.raises(Overloaded):
+                pipeline(dict(ctx))
+        return ctx
+
+    pipeline = core.Pipeline(handler, limit)
+
+    assert pipeline({'x': 1}) == {'x': 1}
+    assert limit.info()['rejected'] == 1
+    assert limit.info()['in_flight'] == 0
+
+
+def test_limit_queues_by_priority():
+    limit = ConcurrencyLimit('admission', initial_limit=1, max_limit=1,
+                             policy='queue', priority=('priority', ))
+    release = threading.Event()
+    order = []
+
+    def handler(ctx):
+        if ctx['priority'] is None:
+            release.wait()
+        order.append(ctx['priority'])
+        return ctx
+
+    pipeline = core.Pipeline(handler, limit)
+    threads = [threading.Thread(target=pipeline, args=({'priority': None}, ))]
+    threads[0].start()
+    while limit.in_flight < 1:
+        time.sleep(0.001)
+
+    for priority in (3, 1, 2):
+        threads.append(
+            threading.Thread(target=pipeline, args=({'priority': priority}, )))
+        threads[-1].start()
+        while limit.queued < len(threads) - 1:
+            time.sleep(0.001)
+
+    assert limit.info()['queued'] == 3
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert order == [None, 1, 2, 3]
+    assert limit.info()['queued'] == 0
+
+
+def test_limit_queue_bounds():
+    limit = ConcurrencyLimit('admission', initial_limit=1, policy='queue',
+                             max_queue=1, timeout=0.01)
+    release = threading.Event()
+
+    def handler(ctx):
+        release.wait()
+        return ctx
+
+    pipeline = core.Pipeline(handler, limit)
+    thread = threading.Thread(target=pipeline, args=({}, ))
+    thread.start()
+    while limit.in_flight < 1:
+        time.sleep(0.001)
+
+    with pytest.raises(Overloaded):
+        pipeline({})
+    release.set()
+    thread.join()
+
+    assert limit.info()['rejected'] == 1
+    assert limit.info()['queued'] == 0
+
+
+def test_limit_adapts():
+    limit = ConcurrencyLimit('admission', initial_limit=4, max_limit=8)
+
+    limit._adapt(10**6)
+    limit.in_flight = 4
+    for _ in range(20):
+        limit._adapt(10**6)
+    limit.in_flight = 0
+    assert limit.limit > 4
+
+    for _ in range(20):
+        limit._adapt(10**8)
+    assert limit.limit == 1
+
+    limit._adapt(None)
+    assert limit.limit == 1
+
+    with pytest.raises(ValueError):
+        ConcurrencyLimit('admission', initial_limit=0)
+    with pytest.raises(ValueError):
+        ConcurrencyLimit('admission', policy='drop')
+
+
+def test_limit_baseline_window():
+    limit = ConcurrencyLimit('admission', initial_limit=4, max_limit=8,
+                             window=10)
+
+    limit._adapt(10**3)
+    for _ in range(20):
+        limit._adapt(10**6)
+    assert limit.limit == 1
+
+    limit.in_flight = 1
+    for _ in range(20):
+        limit._adapt(10**6)
+    assert limit.limit > 1
+
+
+def test_limit_ignores_errors():
+    limit = ConcurrencyLimit('admission', initial_limit=4, max_limit=8)
+
+    def fail(ctx):
+        raise ValueError('fail')
+
+    handler = limit(fail)
+    for _ in range(10):
+        with pytest.raises(ValueError):
+            handler({})
+
+    assert limit._baseline is None and limit._window_min is None
+    assert limit.info()['limit'] == 4
+    assert limit.info()['in_flight'] == 0
+
+
+def test_limit_async():
+    limit = ConcurrencyLimit('admission', initial_limit=2, max_limit=2,
+                             policy='queue')
+    peak = [0]
+
+    async def handler(ctx):
+        peak[0] = max(peak[0], limit.in_flight)
+        await asyncio.sleep(0.01)
+        return ctx
+
+    pipeline = aio.AsyncPipeline(handler, limit)
+
+    async def main():
+        return await asyncio.gather(*(pipeline({'k': k}) for k in range(6)))
+
+    assert [ctx['k'] for ctx in asyncio.run(main())] == list(range(6))
+    assert peak[0] == 2
+    assert limit.info()['admitted'] == 6
+    assert limit.info()['in_flight'] == 0
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+import random
+
+import pytest
+
+import midware.core as core
+from midware.persistent import PersistentMap
+
+
+class Colliding:
+    def __init__(self, name):
+        self.name = name
+
+    def __hash__(self):
+        return 42
+
+    def __eq__(self, other):
+        return isinstance(other, Colliding) and self.name == other.name
+
+    def __repr__(self):
+        return 'Colliding({!r})'.format(self.name)
+
+
+def test_against_dict():
+    rng = random.Random(0)
+    keys = list(range(500)) + ['k{}'.format(k) for k in range(500)] + [
+        Colliding(k) for k in range(5)
+    ]
+
+    m = PersistentMap()
+    d = {}
+    versions = []
+
+    for _ in range(5000):
+        k = rng.choice(keys)
+        if rng.random() < 0.7:
+            v = rng.random()
+            m = m.assoc(k, v)
+            d[k] = v
+        else:
+            m = m.dissoc(k)
+            d.pop(k, None)
+        versions.append((m, dict(d)))
+
+    for m, d in versions[::250]:
+        assert len(m) == len(d)
+        assert dict(m.items()) == d
+        assert m == d
+        for k in keys:
+            assert m.get(k, 'missing') == d.get(k, 'missing')
+            assert (k in m) == (k in d)
+
+
+def test_bulk_construction():
+    d = {k: str(k) for k in range(3000)}
+    d.update({Colliding(k): k for k in range(3)})
+
+    m = PersistentMap(d)
+
+    assert len(m) == len(d)
+    assert m == d
+    assert m.assoc(0, m[0]) is m
+    assert m.dissoc('missing') is m
+
+
+def test_versions_are_independent():
+    m1 = PersistentMap(a=1)
+    m2 = m1.assoc('b', 2)
+    m3 = m2.assoc('a', 3).dissoc('b')
+
+    assert m1 == {'a': 1}
+    assert m2 == {'a': 1, 'b': 2}
+    assert m3 == {'a': 3}
+
+    with pytest.raises(KeyError):
+        m1['b']
+
+
+def test_from_dict_to_dict():
+    d = {'a': {'b': {'c': 1}}, 'd': [1, 2]}
+    m = PersistentMap.from_dict(d)
+
+    assert isinstance(m['a'], PersistentMap)
+    assert isinstance(m['a']['b'], PersistentMap)
+    assert m.to_dict() == d
+
+
+def test_get_in_assoc_in():
+    ctx = PersistentMap.from_dict({'a': {'b': 0}, 'c': 1})
+
+    new_ctx = core.assoc_in(ctx, ('a', 'b'), 1)
+    new_ctx = core.assoc_in(new_ctx, ('x', 'y'), 2)
+
+    assert core.get_in(ctx, ('a', 'b')) == 0
+    assert core.get_in(new_ctx, ('a', 'b')) == 1
+    assert core.get_in(new_ctx, ('x', 'y')) == 2
+    assert core.get_in(new_ctx, ('c', 'd'), 'default') == 'default'
+    assert isinstance(new_ctx['x'], PersistentMap)
+    assert new_ctx['c'] is ctx['c']
+
+    with pytest.raises(TypeError):
+        core.assoc_in(ctx, ('c', 'd'), 0)
+
+
+def test_assoc_in_creates_levels():
+    ctx = PersistentMap(a=1)
+
+    new_ctx = core.assoc_in(ctx, ('x', 'y', 'z'), 1)
+    assert new_ctx == {'a': 1, 'x': {'y': {'z': 1}}}
+    assert isinstance(new_ctx['x']['y'], PersistentMap)
+    assert core.path('x', 'y', 'z').set(PersistentMap(), 2) == {
+        'x': {
+            'y': {
+                'z': 2
+            }
+        }
+    }
+
+    with pytest.raises(TypeError):
+        core.assoc_in(ctx, ('a', 'b', 'c'), 0)
+    with pytest.raises(TypeError):
+        core.path('a', 'b', 'c').set(ctx, 0)
+
+
+def test_assoc_in_copies_dicts():
+    inner = {'b': 0}
+    ctx = PersistentMap(a=inner)
+
+    new_ctx = core.assoc_in(ctx, ('a', 'b'), 1)
+
+    assert inner == {'b': 0}
+    assert new_ctx['a'] == {'b': 1}
+
+
+def test_path():
+    ctx = PersistentMap.from_dict({'a': {'b': 0}})
+    p = core.path('a', 'b')
+
+    assert p.get(ctx) == 0
+    assert p.set(ctx, 1) == {'a': {'b': 1}}
+    assert p.update(ctx, lambda v: v + 2) == {'a': {'b': 2}}
+    assert p.delete(ctx) == {'a': {}}
+    assert ctx == {'a': {'b': 0}}
+
+
+def test_hash_and_pickle():
+    m = PersistentMap.from_dict({'a': {'b': 0}})
+
+    assert hash(m) == hash(PersistentMap.from_dict({'a': {'b': 0}}))
+    assert pickle.loads(pickle.dumps(m)) == m
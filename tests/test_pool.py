@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from functools import partial
+
+import pytest
+
+import midware.core as core
+from midware.pool import ResourcePool, mw_from_pool
+
+
+class Connection:
+    def __init__(self, log, host='localhost'):
+        self.log = log
+        self.host = host
+        self.open = False
+
+    def __enter__(self):
+        self.open = True
+        self.log.append(('open', self.host))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.open = False
+        self.log.append(('close', self.host))
+
+
+def test_pool_reuses_resources():
+    log = []
+    pool = ResourcePool(partial(Connection, log))
+
+    with pool.checkout() as first:
+        pass
+    with pool.checkout() as second:
+        with pool.checkout(host='other') as other:
+            assert other.host == 'other'
+
+    assert first is second
+    assert log == [('open', 'localhost'), ('open', 'other')]
+
+    stats = pool.stats()
+    assert stats['size'] == 2
+    assert stats['in_use'] == 0
+    assert stats['checkouts'] == 3
+    assert stats['created'] == 2
+
+    pool.close()
+    assert sorted(log[2:]) == [('close', 'localhost'), ('close', 'other')]
+    with pytest.raises(RuntimeError):
+        pool.checkout().__enter__()
+
+
+def test_pool_validates_and_expires():
+    log = []
+    pool = ResourcePool(partial(Connection, log), validate=lambda c: c.open, ttl=0.01)
+
+    with pool.checkout() as conn:
+        pass
+    conn.open = False
+    with pool.checkout() as new_conn:
+        assert new_conn is not conn
+
+    time.sleep(0.02)
+    pool.prune()
+
+    assert log == [('open', 'localhost'), ('close', 'localhost'),
+                   ('open', 'localhost'), ('close', 'localhost')]
+    assert pool.stats()['size'] == 0
+    assert pool.stats()['discarded'] == 2
+
+
+def test_pool_discard_errors():
+    class BrokenConnection(Connection):
+        def __exit__(self, *exc_info):
+            super().__exit__(*exc_info)
+            raise OSError(self.host)
+
+    log = []
+    pool = ResourcePool(partial(BrokenConnection, log), ttl=0.01)
+
+    for host in ('a', 'b'):
+        with pool.checkout(host=host):
+            pass
+    time.sleep(0.02)
+
+    with pool.checkout(host='c') as conn:
+        assert conn.host == 'c'
+
+    assert sorted(log[2:4]) == [('close', 'a'), ('close', 'b')]
+    stats = pool.stats()
+    assert stats['size'] == 1
+    assert stats['discarded'] == 2
+    assert stats['close_errors'] == 2
+    assert isinstance(pool.last_close_error, OSError)
+
+
+def test_pool_bounded():
+    log = []
+    pool = ResourcePool(partial(Connection, log), maxsize=1, timeout=0.01)
+
+    with pool.checkout():
+        with pytest.raises(TimeoutError):
+            with pool.checkout():
+                pass
+
+        assert pool.stats()['utilisation'] == 1.0
+
+    checked_out = threading.Event()
+
+    def hold():
+        with pool.checkout():
+            checked_out.set()
+            time.sleep(0.05)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    checked_out.wait()
+
+    pool.timeout = None
+    with pool.checkout():
+        pass
+    thread.join()
+
+    assert len(log) == 1
+    assert pool.stats()['max_wait_s'] > 0.01
+
+
+def test_pool_wait_excludes_opening():
+    class SlowConnection(Connection):
+        def __enter__(self):
+            time.sleep(0.05)
+            return super().__enter__()
+
+    pool = ResourcePool(partial(SlowConnection, []))
+    with pool.checkout():
+        pass
+
+    assert pool.stats()['max_wait_s'] < 0.05
+
+
+def test_mw_from_pool():
+    log = []
+    pool = ResourcePool(partial(Connection, log))
+    mw = mw_from_pool('db', pool, ('db', ), {'host': ('host', )})
+
+    def handler(ctx):
+        ctx['seen'] = ctx['db'].host
+        return ctx
+
+    pipeline = core.Pipeline(handler, mw)
+
+    assert pipeline({'host': 'a'})['seen'] == 'a'
+    assert pipeline({'host': 'a'})['seen'] == 'a'
+    assert log == [('open', 'a')]
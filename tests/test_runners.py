@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+
+import pytest
+
+import midware.core as core
+import midware.runners as runners
+
+
+@core.middleware('wrap_double')
+def wrap_double(ctx):
+    ctx['value'] *= 2
+
+    new_ctx = yield ctx
+
+    yield new_ctx
+
+
+def check_positive(ctx):
+    if ctx['value'] < 0:
+        raise ValueError(ctx['value'])
+    return ctx
+
+
+def ctxs(*values):
+    return ({'value': v} for v in values)
+
+
+def test_run_many():
+    built = []
+
+    def counting_layer(handler):
+        built.append(handler)
+        return handler
+
+    run = runners.run_many(ctxs(1, 2, 3), core.identity, counting_layer,
+                           wrap_double)
+
+    assert [ctx['value'] for ctx in run] == [2, 4, 6]
+    assert len(built) == 1
+    assert run.processed == 3
+    assert run.failed == 0
+    assert run.throughput > 0
+
+
+def test_run_many_is_lazy():
+    run = runners.run_many(({'value': v} for v in itertools.count()),
+                           core.identity, wrap_double)
+
+    assert [ctx['value'] for ctx in itertools.islice(run, 3)] == [0, 2, 4]
+    assert run.processed == 3
+
+
+def test_run_many_chunks():
+    run = runners.run_many(ctxs(1, 2, 3, 4, 5), core.identity, chunksize=2)
+
+    assert [[ctx['value'] for ctx in chunk] for chunk in run] == [[1, 2],
+                                                                  [3, 4], [5]]
+
+
+def test_run_many_raise():
+    run = runners.run_many(ctxs(1, -1, 2), check_positive)
+
+    assert next(run) == {'value': 1}
+    with pytest.raises(ValueError):
+        next(run)
+    assert list(run) == []
+    assert run.failed == 1
+
+
+def test_run_many_skip():
+    run = runners.run_many(ctxs(1, -1, 2), check_positive, errors='skip')
+
+    assert list(run) == [{'value': 1}, {'value': 2}]
+    assert run.processed == 2
+    assert run.failed == 1
+
+
+def test_run_many_yield():
+    run = runners.run_many(ctxs(1, -1), check_positive, errors='yield')
+
+    ok, error = list(run)
+    assert ok == {'value': 1}
+    assert isinstance(error, ValueError)
+
+
+def test_run_many_unknown_policy():
+    with pytest.raises(ValueError):
+        runners.run_many([], core.identity, errors='ignore')
+
+
+def test_pipeline_pickles():
+    import pickle
+
+    pipeline = core.Pipeline(core.identity, wrap_double)
+    new_pipeline = pickle.loads(pickle.dumps(pipeline))
+
+    assert new_pipeline({'value': 2}) == {'value': 4}
+    assert new_pipeline.middleware == (wrap_double, )
+
+
+def test_run_parallel_threads():
+    pipeline = core.Pipeline(check_positive, wrap_double)
+    results = runners.run_parallel(ctxs(*range(20)), pipeline, workers=4)
+
+    assert [ctx['value'] for ctx in results] == [2 * v for v in range(20)]
+
+
+def test_run_parallel_unordered():
+    pipeline = core.Pipeline(check_positive, wrap_double)
+    results = runners.run_parallel(
+        ctxs(*range(20)), pipeline, workers=4, ordered=False)
+
+    assert sorted(ctx['value'] for ctx in results) == [
+        2 * v for v in range(20)
+    ]
+
+
+def test_run_parallel_processes():
+    pipeline = core.Pipeline(check_positive, wrap_double)
+    results = runners.run_parallel(
+        ctxs(1, 2, 3), pipeline, executor='processes', workers=2)
+
+    assert [ctx['value'] for ctx in results] == [2, 4, 6]
+
+
+def test_run_parallel_bounded():
+    taken = []
+
+    def values():
+        for v in itertools.count():
+            taken.append(v)
+            yield {'value': v}
+
+    pipeline = core.Pipeline(check_positive)
+    results = runners.run_parallel(
+        values(), pipeline, workers=2, max_in_flight=3)
+
+    assert next(results) == {'value': 0}
+    assert len(taken) == 4
+    results.close()
+
+
+def test_run_parallel_raise():
+    pipeline = core.Pipeline(check_positive)
+    results = runners.run_parallel(ctxs(1, -1, 2), pipeline, workers=2)
+
+    assert next(results) == {'value': 1}
+    with pytest.raises(ValueError):
+        next(results)
+
+
+def test_run_parallel_unknown_executor():
+    with pytest.raises(ValueError):
+        runners.run_parallel([], core.identity, executor='fibers')
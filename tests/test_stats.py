@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import midware.aio as aio
+import midware.core as core
+import midware.stats as stats
+
+
+def test_histogram_percentiles():
+    h = stats.Histogram()
+    assert h.percentile(50) is None
+
+    for v in range(1, 1001):
+        h.record(v * 1000)
+
+    for q in (50, 90, 99, 99.9):
+        assert h.percentile(q) == pytest.approx(q * 10000, rel=0.07)
+
+
+def test_histogram_small_and_huge_values():
+    h = stats.Histogram()
+    for v in (0, 1, 15, 2**70):
+        h.record(v)
+
+    assert h.percentile(25) == 0
+    assert h.percentile(50) == 1
+    assert h.percentile(75) == 15
+    assert h.percentile(100) > 2**47
+
+
+@core.named('outer')
+def outer(handler):
+    def new_handler(ctx):
+        time.sleep(0.01)
+        return handler(ctx)
+
+    return new_handler
+
+
+@core.middleware('inner')
+def inner(ctx):
+    new_ctx = yield ctx
+    if new_ctx.get('fail'):
+        raise ValueError('fail')
+    yield new_ctx
+
+
+def slow(ctx):
+    time.sleep(0.02)
+    return ctx
+
+
+def test_stats():
+    collected = stats.Stats()
+    pipeline = core.Pipeline(slow, outer, inner, instrument=collected)
+
+    pipeline({})
+    with pytest.raises(ValueError):
+        pipeline({'fail': True})
+
+    result = collected.as_dict()
+
+    assert set(result) == {'outer', 'inner'}
+    assert result['outer']['calls'] == result['inner']['calls'] == 2
+    assert result['outer']['errors'] == result['inner']['errors'] == 1
+
+    assert result['inner']['exclusive_ns'] == result['inner']['inclusive_ns']
+    assert result['outer']['exclusive_ns'] == (
+        result['outer']['inclusive_ns'] - result['inner']['inclusive_ns'])
+    assert result['outer']['exclusive_ns'] >= 2 * 10**7
+    assert result['inner']['exclusive_ns'] >= 4 * 10**7
+
+    assert result['outer']['p50_ns'] >= 3 * 10**7
+    assert result['outer']['p50_ns'] <= result['outer']['p999_ns']
+
+
+def test_stats_reset():
+    collected = stats.Stats()
+    core.wrap_and_call({}, core.identity, outer, instrument=collected)
+
+    assert collected.reset()['outer']['calls'] == 1
+    assert collected.as_dict() == {}
+
+
+def test_stats_threads():
+    collected = stats.Stats()
+    pipeline = core.Pipeline(core.identity, inner, instrument=collected)
+
+    def run():
+        for _ in range(1000):
+            pipeline({})
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for t in threads:
+        t.start()
+    run()
+    first = collected.reset()
+    for t in threads:
+        t.join()
+
+    second = collected.as_dict().get('inner', {'calls': 0})
+    assert first['inner']['calls'] + second['calls'] == 5000
+
+
+@aio.middleware('task')
+async def task(ctx):
+    new_ctx = yield ctx
+    yield new_ctx
+
+
+def test_stats_tasks():
+    collected = stats.Stats()
+    sync = core.Pipeline(slow, inner, instrument=collected)
+
+    async def handler(ctx):
+        await asyncio.sleep(0.01)
+        return sync(ctx)
+
+    pipeline = aio.AsyncPipeline(handler, task, instrument=collected)
+
+    async def main():
+        await asyncio.gather(*(pipeline({}) for _ in range(3)))
+
+    asyncio.run(main())
+    result = collected.as_dict()
+
+    assert result['task']['calls'] == result['inner']['calls'] == 3
+    assert result['task']['exclusive_ns'] == (
+        result['task']['inclusive_ns'] - result['inner']['inclusive_ns'])
+    assert result['task']['exclusive_ns'] >= 3 * 10**7
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import io
+import json
+
+import pytest
+
+import midware.aio as aio
+import midware.core as core
+import midware.trace as trace
+
+
+@core.named('outer')
+def outer(handler):
+    def new_handler(ctx):
+        return handler(ctx)
+
+    return new_handler
+
+
+@core.middleware('inner')
+def inner(ctx):
+    new_ctx = yield ctx
+    yield new_ctx
+
+
+def fail(ctx):
+    raise KeyError('fail')
+
+
+def test_tracer_events():
+    tracer = trace.Tracer()
+    core.wrap_and_call({}, core.identity, outer, inner, instrument=tracer)
+
+    spans = [e for e in tracer.events() if e['ph'] == 'X']
+    assert [e['name'] for e in spans] == ['outer', 'inner']
+
+    outer_span, inner_span = spans
+    assert outer_span['ts'] <= inner_span['ts']
+    assert (inner_span['ts'] + inner_span['dur'] <=
+            outer_span['ts'] + outer_span['dur'])
+    assert outer_span['tid'] == inner_span['tid']
+
+    tracks = [e for e in tracer.events() if e['ph'] == 'M']
+    assert len(tracks) == 1
+    assert tracks[0]['args']['name'].startswith('Thread ')
+
+
+def test_tracer_errors():
+    tracer = trace.Tracer()
+
+    with pytest.raises(KeyError):
+        core.wrap_and_call({}, fail, outer, instrument=tracer)
+
+    span, = [e for e in tracer.events() if e['ph'] == 'X']
+    assert span['args'] == {'error': "KeyError('fail')"}
+
+
+def test_tracer_ring_buffer():
+    tracer = trace.Tracer(capacity=4)
+    pipeline = core.Pipeline(core.identity, outer, inner, instrument=tracer)
+
+    for _ in range(5):
+        pipeline({})
+
+    assert len(tracer.spans()) == 4
+    assert tracer.dropped() == 6
+
+    tracer.clear()
+    assert tracer.spans() == []
+    assert tracer.dropped() == 0
+
+
+def test_tracer_tasks():
+    tracer = trace.Tracer()
+    pipeline = aio.AsyncPipeline(core.identity, inner, instrument=tracer)
+
+    async def main():
+        await asyncio.gather(*(pipeline({}) for _ in range(3)))
+
+    asyncio.run(main())
+
+    events = tracer.events()
+    assert len({e['tid'] for e in events if e['ph'] == 'X'}) == 3
+    assert all(e['args']['name'].split(' on thread ')[0]
+               for e in events if e['ph'] == 'M')
+
+
+def test_tracer_dump():
+    tracer = trace.Tracer()
+    core.wrap_and_call({}, core.identity, outer, instrument=tracer)
+
+    f = io.StringIO()
+    tracer.dump(f)
+
+    trace_json = json.loads(f.getvalue())
+    assert trace_json['traceEvents'] == tracer.events()